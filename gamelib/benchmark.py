@@ -0,0 +1,152 @@
+'''Benchmark sessions.
+
+Plays a fixed, scripted session twice: once under cProfile, saving stats
+for pstats, and once with StackSampler watching, which barely slows the game
+down, saving what it saw as collapsed stacks for flamegraph.pl. Timings are
+taken from the sampled run, so they can be compared between builds.
+
+By default only the physics is run, without a window; --render plays the
+session through the game, drawing every frame.
+'''
+
+import cProfile
+import optparse
+import os
+import pstats
+import random
+import sys
+import thread
+import threading
+import time
+
+import headless
+import level
+from simulation import PHYSICS_STEP
+
+BENCHMARK_SEED = 0 # Nothing is random yet; seeded so it stays repeatable
+BENCHMARK_DURATION = 20.0 # Seconds of game time in a session
+SAMPLE_INTERVAL = 0.001 # Seconds between stack samples
+
+class StackSampler(object):
+    '''Counts the call stacks a thread is seen in, from a second thread.'''
+    def __init__(self, interval=SAMPLE_INTERVAL, thread_id=None):
+        if thread_id is None:
+            thread_id = thread.get_ident()
+        self.interval = interval
+        self.thread_id = thread_id
+        self.stacks = {}
+        self.samples = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def run(self):
+        while self.running:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name,
+                             os.path.basename(code.co_filename),
+                             code.co_firstlineno))
+                frame = frame.f_back
+            if not stack:
+                continue
+            stack.reverse()
+            stack = ';'.join(stack)
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def save(self, filename):
+        '''Write the stacks seen in the collapsed format of flamegraph.pl.'''
+        f = open(filename, 'w')
+        try:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (stack, count))
+        finally:
+            f.close()
+
+def create_session(duration, timeline, name, render):
+    '''Return a function that plays the session and returns the number of
+    physics steps run.
+    '''
+    if render:
+        import game # Opens the window, so only when asked to
+        def session():
+            game.run_session(timeline, duration, draw=True)
+            return game.sim.steps
+    else:
+        def session():
+            timeline.rewind()
+            sim = headless.create_simulation(name=name)
+            return headless.run(duration, timeline, sim)[0].steps
+    return session
+
+def run(session, output, interval=SAMPLE_INTERVAL):
+    '''Play "session" under cProfile then under a StackSampler, saving
+    "output".prof and "output".collapsed. Returns (steps, elapsed) of the
+    sampled run.
+    '''
+    random.seed(BENCHMARK_SEED)
+    profiler = cProfile.Profile()
+    profiler.runcall(session)
+    profiler.dump_stats(output + '.prof')
+
+    random.seed(BENCHMARK_SEED)
+    sampler = StackSampler(interval)
+    sampler.start()
+    start = time.time()
+    steps = session()
+    elapsed = time.time() - start
+    sampler.stop()
+    sampler.save(output + '.collapsed')
+
+    stats = pstats.Stats(output + '.prof')
+    stats.sort_stats('time', 'calls')
+    stats.print_stats(20)
+    print '%d stack samples saved to %s.collapsed' % (sampler.samples,
+                                                     output)
+    return steps, elapsed
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-d', '--duration', type='float',
+                      default=BENCHMARK_DURATION,
+                      help='seconds of game time to play (default: %default)')
+    parser.add_option('-l', '--level', default=level.FIRST_LEVEL,
+                      help='level to play, without --render')
+    parser.add_option('-t', '--timeline',
+                      help='input timeline file (default: hold right)')
+    parser.add_option('-r', '--render', action='store_true',
+                      help='play through the game, drawing every frame')
+    parser.add_option('-o', '--output', default='benchmark',
+                      help='prefix of the files written (default: %default)')
+    parser.add_option('-i', '--interval', type='float',
+                      default=SAMPLE_INTERVAL,
+                      help='seconds between stack samples (default: %default)')
+    options, args = parser.parse_args()
+
+    if options.timeline:
+        timeline = headless.Timeline.load(options.timeline)
+    else:
+        timeline = headless.Timeline()
+
+    session = create_session(options.duration, timeline, options.level,
+                             options.render)
+    steps, elapsed = run(session, options.output, options.interval)
+    print '%d steps in %.3f seconds (%.0f steps/s, %.1fx real time)' % (
+        steps, elapsed, steps / max(elapsed, 1e-9),
+        steps * PHYSICS_STEP / max(elapsed, 1e-9))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+'''Scrolling camera.
+
+Sprites in a Camera group are placed in world coordinates and the whole
+group is moved on screen by one modelview translation, so scrolling doesn't
+touch any vertices.
+'''
+
+import pyglet
+
+class Camera(pyglet.graphics.Group):
+    def __init__(self, parent=None):
+        super(Camera, self).__init__(parent)
+        self.offset = (0, 0)
+
+    def get_view(self, width, height):
+        '''Return the (left, bottom, right, top) of the world seen in a
+        "width" by "height" window.
+        '''
+        x, y = self.offset
+        return -x, -y, width - x, height - y
+
+    def set_state(self):
+        pyglet.gl.glPushMatrix()
+        pyglet.gl.glTranslatef(int(self.offset[0]), int(self.offset[1]), 0)
+
+    def unset_state(self):
+        pyglet.gl.glPopMatrix()
@@ -1,10 +1,141 @@
 #!/usr/bin/evn python
 
+import cProfile
+import ctypes
+import pstats
 import pyglet
+import Queue
+import StringIO
 import sys
+import thread
+import threading
+import time
+import timeit
+import types
 from pyglet.window import key
 
 INPUT_INDICATOR = ">>> "
+MAX_LINES = 200 # Lines of scrollback kept above the prompt
+BACKGROUND_PREFIX = "&" # Commands starting with this run on a worker thread
+TASK_TIME_BUDGET = 0.004 # Most seconds spent stepping generators per frame
+MAGIC_PREFIX = "%" # Commands starting with this are console magics
+TIMEIT_MIN_TIME = 0.2 # Seconds a batch of %timeit loops must run for
+TIMEIT_REPEATS = 3
+PROFILE_LINES = 15 # Functions listed by %profile
+WATCH_FRAMES = 30 # Frames between refreshes of a %watch
+
+def format_time(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e3), ("us", 1e6)):
+        if seconds >= 1 / scale:
+            return "%.3g %s" % (seconds * scale, unit)
+    return "%.3g ns" % (seconds * 1e9)
+
+class GeneratorTask(object):
+    '''Steps a generator returned by a command a little every frame,
+    logging whatever it yields.
+    '''
+    def __init__(self, command, generator):
+        self.command = command
+        self.generator = generator
+
+    def step(self, console, deadline):
+        '''Run until "deadline"; returns True once the generator is done.'''
+        while time.time() < deadline:
+            try:
+                output = self.generator.next()
+            except StopIteration:
+                return True
+            except Exception, inst:
+                console.write(repr(inst))
+                return True
+            if output is not None:
+                console.write(str(output))
+        return False
+
+    def cancel(self):
+        '''Stop the generator; returns True as it's stopped straight away.'''
+        self.generator.close()
+        return True
+
+class ThreadTask(object):
+    '''Evaluates a command on a worker thread. The command can log partial
+    output with Console.log().
+    '''
+    def __init__(self, command, console):
+        self.command = command
+        self.console = console
+        self.done = False
+
+        # cancel() only interrupts the thread once it's known and until it
+        # starts finishing, both checked under the lock
+        self.lock = threading.RLock()
+        self.cancelled = False
+        self.finishing = False
+        self.thread_id = None
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        # The interrupt can land anywhere until "finishing" is set and one
+        # sent late is dropped, so until then everything is retried
+        output = None
+        while True:
+            try:
+                if output is None:
+                    output = self.evaluate()
+                self.finishing = True
+                # Wait out a cancel() that saw "finishing" unset, then drop
+                # the interrupt it may have sent
+                self.lock.acquire()
+                self.lock.release()
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                    ctypes.c_long(self.thread_id), None)
+                break
+            except KeyboardInterrupt:
+                output = "Cancelled: " + self.command
+
+        # Nothing can interrupt this any more
+        self.console.log(output)
+        self.done = True
+
+    def evaluate(self):
+        self.lock.acquire()
+        try:
+            self.thread_id = thread.get_ident()
+            # Cancelled before cancel() could know which thread to stop
+            if self.cancelled:
+                return "Cancelled: " + self.command
+        finally:
+            self.lock.release()
+        try:
+            return repr(eval(self.command, self.console.globals, {}))
+        except Exception, inst:
+            return repr(inst)
+
+    def step(self, console, deadline):
+        return self.done
+
+    def cancel(self):
+        '''Interrupt the command with a KeyboardInterrupt, raised in the
+        worker thread the next time it runs Python code. Returns False, as
+        the thread logs that it was cancelled itself once it has stopped.
+        '''
+        # Only ever one interrupt, and none once finishing, when run() may
+        # have been interrupted holding the lock
+        if self.cancelled or self.finishing:
+            return False
+        self.lock.acquire()
+        try:
+            self.cancelled = True
+            if self.thread_id is not None and not self.finishing:
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                    ctypes.c_long(self.thread_id),
+                    ctypes.py_object(KeyboardInterrupt))
+        finally:
+            self.lock.release()
+        return False
 
 class Console(object):
     def __init__(self, window, globals):
@@ -20,41 +151,270 @@ class Console(object):
         self.caret.color = (255, 255, 255)
         self.caret.position = len(self.document.text)
 
+        # The log is only ever appended to, just above the prompt line, and
+        # trimmed from the front, so each command costs the same however
+        # long the console has been open
+        self.prompt_start = 0
+        self.lines = 0
+
+        # Commands still running, and output logged from other threads
+        self.tasks = []
+        self.incoming = Queue.Queue()
+        self.main_thread = thread.get_ident()
+
+        # Expressions shown live in the top right, see magic_watch()
+        self.watches = []
+        self.watch_label = pyglet.text.Label(font_size=10,
+                                             color=(0, 0, 0, 192),
+                                             multiline=True, width=300,
+                                             anchor_x="right",
+                                             anchor_y="top",
+                                             x=window.width - 10,
+                                             y=window.height - 10)
+        self.scheduled = False
+
     def is_active(self):
         return self.active
 
     def toggle(self):
         self.active = not self.active
 
+    def draw(self):
+        if self.active:
+            self.layout.draw()
+        if self.watches:
+            self.watch_label.draw()
+
     def run_input(self):
         command = self.get_command()
         self.history.append(command)
+        self.history_steps = 0
+
+        # The command line becomes part of the log, under a new prompt
+        end = len(self.document.text)
+        self.document.insert_text(end, "\n" + INPUT_INDICATOR)
+        self.prompt_start = end + 1
+        self.lines += 1
+        self.reset_caret()
+
+        if command.startswith(MAGIC_PREFIX):
+            self.run_magic(command[len(MAGIC_PREFIX):])
+            return
+        if command.startswith(BACKGROUND_PREFIX):
+            command = command[len(BACKGROUND_PREFIX):].strip()
+            self.start_task(ThreadTask(command, self))
+            return
         try:
-            output = repr(eval(command, self.globals, {}))
+            result = eval(command, self.globals, {})
         except Exception, inst:
-            output = repr(inst)
-        self.document.text += "\n" + output + "\n" + INPUT_INDICATOR
-        self.caret.position = len(self.document.text)
-        self.history_steps = 0
+            self.write(repr(inst))
+            return
+        if isinstance(result, types.GeneratorType):
+            self.start_task(GeneratorTask(command, result))
+        else:
+            self.write(repr(result))
+
+    def run_magic(self, line):
+        parts = line.split(None, 1)
+        name = parts and parts[0] or ""
+        argument = len(parts) > 1 and parts[1].strip() or ""
+        magic = getattr(self, "magic_" + name, None)
+        if magic is None:
+            self.write("Unknown magic %s%s, try %%timeit, %%profile, "
+                       "%%watch or %%stats" % (MAGIC_PREFIX, name))
+            return
+        try:
+            magic(argument)
+        except Exception, inst:
+            self.write(repr(inst))
+
+    def magic_timeit(self, expression):
+        '''%timeit expression: time it, looping more until it's measurable.'''
+        code = compile(expression, "<console>", "eval")
+        globals = self.globals
+
+        # Finer than time.time on Windows, where that ticks every 15.6 ms
+        timer = timeit.default_timer
+
+        def run(loops):
+            start = timer()
+            for loop in xrange(loops):
+                eval(code, globals, {})
+            return timer() - start
+
+        loops = 1
+        elapsed = run(loops)
+        while elapsed < TIMEIT_MIN_TIME:
+            loops *= 10
+            elapsed = run(loops)
+        for repeat in xrange(TIMEIT_REPEATS - 1):
+            elapsed = min(elapsed, run(loops))
+        self.write("%d loops, best of %d: %s per loop" % (
+            loops, TIMEIT_REPEATS, format_time(elapsed / loops)))
+
+    def magic_profile(self, expression):
+        '''%profile expression: list the functions it spends most time in.'''
+        code = compile(expression, "<console>", "eval")
+        profile = cProfile.Profile()
+        result = profile.runcall(eval, code, self.globals, {})
+        output = StringIO.StringIO()
+        stats = pstats.Stats(profile, stream=output)
+        stats.sort_stats("time", "calls")
+        stats.print_stats(PROFILE_LINES)
+        self.write(output.getvalue().strip())
+        self.write(repr(result))
+
+    def magic_watch(self, expression):
+        '''%watch expression: show its value, refreshed every WATCH_FRAMES
+        frames. %watch on its own stops all watches.
+        '''
+        if not expression:
+            self.watches = []
+        else:
+            code = compile(expression, "<console>", "eval")
+            self.watches.append([expression, code, 1])
+        self.set_scheduled()
+
+    def magic_stats(self, argument):
+        '''%stats: frame rate and what every batch in the globals holds.'''
+        self.write("%.1f fps" % pyglet.clock.get_fps())
+        names = self.globals.keys()
+        names.sort()
+        for name in names:
+            batch = self.globals[name]
+            if not isinstance(batch, pyglet.graphics.Batch):
+                continue
+            domains = []
+            for domain_map in batch.group_map.values():
+                domains.extend(domain_map.values())
+            capacity = used = fragmented = 0
+            for domain in domains:
+                allocator = domain.allocator
+                capacity += allocator.capacity
+                used += allocator.capacity - allocator.get_free_size()
+                fragmented += allocator.get_fragmented_free_size()
+            self.write("%s: %d groups, %d domains, %d of %d vertices "
+                       "allocated, %d fragmented" % (
+                       name, len(batch.group_map), len(domains), used,
+                       capacity, fragmented))
+
+    def start_task(self, task):
+        self.tasks.append(task)
+        self.set_scheduled()
+
+    def cancel(self):
+        '''Cancel every command still running.
+
+        Tasks that can't be stopped straight away are kept, so update()
+        keeps running until they stop and log that they were cancelled.
+        '''
+        running = []
+        for task in self.tasks:
+            if task.cancel():
+                self.write("Cancelled: " + task.command)
+            else:
+                running.append(task)
+        self.tasks = running
+        self.set_scheduled()
+
+    def set_scheduled(self):
+        '''Keep update() on the clock only while it has work to do.'''
+        needed = bool(self.tasks or self.watches)
+        if needed and not self.scheduled:
+            pyglet.clock.schedule(self.update)
+        elif self.scheduled and not needed:
+            pyglet.clock.unschedule(self.update)
+        self.scheduled = needed
+
+    def update(self, dt):
+        '''Step the running commands, log their output and refresh the
+        watches.
+        '''
+        deadline = time.time() + TASK_TIME_BUDGET
+        for task in self.tasks[:]:
+            if task.step(self, deadline):
+                self.tasks.remove(task)
+        while True:
+            try:
+                self.write(self.incoming.get_nowait())
+            except Queue.Empty:
+                break
+        if self.watches:
+            self.update_watches()
+        self.set_scheduled()
+
+    def update_watches(self):
+        refreshed = False
+        for watch in self.watches:
+            watch[2] -= 1
+            if watch[2] <= 0:
+                watch[2] = WATCH_FRAMES
+                refreshed = True
+        if not refreshed:
+            return
+
+        lines = []
+        for expression, code, frames in self.watches:
+            try:
+                value = repr(eval(code, self.globals, {}))
+            except Exception, inst:
+                value = repr(inst)
+            lines.append("%s = %s" % (expression, value))
+        text = "\n".join(lines)
+        if text != self.watch_label.text:
+            self.watch_label.text = text
+
+    def log(self, text):
+        '''Add "text" to the log; from another thread it's added at the
+        next update.
+        '''
+        if thread.get_ident() == self.main_thread:
+            self.write(str(text))
+        else:
+            self.incoming.put(str(text))
+
+    def write(self, text):
+        '''Add "text" to the log, above the prompt line.'''
+        text += "\n"
+        self.document.insert_text(self.prompt_start, text)
+        if self.caret.position >= self.prompt_start:
+            self.caret.position += len(text)
+        self.prompt_start += len(text)
+        self.lines += text.count("\n")
+        self.trim()
+
+    def trim(self):
+        '''Drop the oldest lines of the log beyond MAX_LINES.'''
+        if self.lines <= MAX_LINES:
+            return
+        text = self.document.text
+        end = 0
+        for line in xrange(self.lines - MAX_LINES):
+            end = text.index("\n", end) + 1
+        self.document.delete_text(0, end)
+        self.caret.position = max(self.caret.position - end, 0)
+        self.prompt_start -= end
+        self.lines = MAX_LINES
 
     def get_command(self):
-        return self.document.text.splitlines()[-1][len(INPUT_INDICATOR):]
+        return self.document.text[self.prompt_start + len(INPUT_INDICATOR):]
 
     def clear_command(self):
-        command = self.get_command()
-        if len(command) > 0:
-            self.document.text = self.document.text[:-len(command)]
+        start = self.prompt_start + len(INPUT_INDICATOR)
+        if len(self.document.text) > start:
+            self.document.delete_text(start, len(self.document.text))
         self.reset_caret()
 
     def reset_caret(self):
         self.caret.position = len(self.document.text)
 
     def at_start(self):
-        indicator_pos = self.document.text.rfind("\n" + INPUT_INDICATOR)
-        if self.caret.position <= indicator_pos + len(INPUT_INDICATOR) + 1 or len(self.document.text) == len(INPUT_INDICATOR):
-            return True
-        return False
+        return self.caret.position <= self.prompt_start + len(INPUT_INDICATOR)
         
+    def on_key_press(self, symbol, modifiers):
+        if symbol == key.C and modifiers & key.MOD_CTRL:
+            self.cancel()
+
     def on_text(self, text):
         if text == "\r":
             self.run_input()
@@ -0,0 +1,164 @@
+'''Collision handling for the simulation.
+
+space.collide() calls near_callback for every pair of geoms whose bounding
+boxes overlap, PHYSICS_STEP times a second, so the work done per pair and per
+contact here adds up quickly.
+'''
+
+import math
+
+import ode
+
+CONTACT_MODE = ode.ContactBounce
+CONTACT_MU = ode.Infinity
+CONTACT_BOUNCE = 0.5
+
+class Material(object):
+    '''The surface of a geom: its friction and bounce.'''
+    def __init__(self, name, mu=CONTACT_MU, bounce=CONTACT_BOUNCE):
+        self.name = name
+        self.mu = mu
+        self.bounce = bounce
+
+    def combine(self, other):
+        '''Return the (mode, mu, bounce) of contacts between two surfaces.
+
+        The pair gets the geometric mean of the frictions and the average of
+        the bounces, so either surface can make it grippier or slipperier,
+        bouncier or deader, and a surface against itself keeps its own.
+        '''
+        if self.mu == 0 or other.mu == 0:
+            mu = 0 # Rather than infinity times zero
+        else:
+            mu = math.sqrt(self.mu * other.mu)
+        return (CONTACT_MODE, mu, (self.bounce + other.bounce) / 2.0)
+
+DEFAULT_MATERIAL = Material('default')
+
+class ContactHandler(object):
+    '''Joins every contact with the same parameters, looking everything up
+    again each time. Kept as the baseline for benchmarking ContactManager.
+    '''
+    def __init__(self, world, contactgroup):
+        self.world = world
+        self.contactgroup = contactgroup
+        self.contacts = 0
+
+    def clear(self):
+        pass
+
+    def set_materials(self, materials):
+        pass
+
+    def add_object(self, physics_object):
+        pass
+
+    def add_geom(self, geom, material):
+        pass
+
+    def near_callback(self, args, geom1, geom2):
+        contacts = ode.collide(geom1, geom2)
+        for contact in contacts:
+            contact.setMode(CONTACT_MODE)
+            contact.setMu(CONTACT_MU)
+            contact.setBounce(CONTACT_BOUNCE)
+            joint = ode.ContactJoint(self.world, self.contactgroup, contact)
+            joint.attach(geom1.getBody(), geom2.getBody())
+        self.contacts += len(contacts)
+
+class ContactManager(ContactHandler):
+    '''Caches what is needed to join each pair of geoms.
+
+    The contact parameters of every pair of materials are worked out up
+    front by set_materials(). The first time a pair of geoms is seen its
+    bodies and parameters are looked up and stored, so later steps only
+    collide the geoms and create the joints. Pairs where neither geom has a
+    body can never move, so they are remembered as skipped and never
+    collided at all.
+
+    Pairs whose bodies are all asleep aren't collided either; a sleeping
+    body touched by an awake one is woken by ODE through the contact joint.
+
+    PyODE owns the contact joints through the joint group, so the joints
+    themselves can't be pooled; everything around them is.
+    '''
+    def __init__(self, world, contactgroup):
+        super(ContactManager, self).__init__(world, contactgroup)
+        self.pairs = {}
+        self.materials = {} # Geom -> Material
+        self.table = {} # (Material, Material) -> (mode, mu, bounce)
+        self.set_materials([])
+        self.skipped = 0
+        self.sleeping = 0
+
+    def clear(self):
+        '''Forget all cached pairs and materials, e.g. when the level's geoms
+        change.
+        '''
+        self.pairs.clear()
+        self.materials.clear()
+
+    def set_materials(self, materials):
+        '''Work out the contact parameters of every pair of "materials".
+
+        Geoms added without a material get DEFAULT_MATERIAL.
+        '''
+        materials = list(materials) + [DEFAULT_MATERIAL]
+        self.table = dict([((material1, material2),
+                            material1.combine(material2))
+                           for material1 in materials
+                           for material2 in materials])
+        self.pairs.clear()
+
+    def add_object(self, physics_object):
+        '''Collide "physics_object"'s geom with its material.'''
+        self.add_geom(physics_object.getGeom(), physics_object.getMaterial())
+
+    def add_geom(self, geom, material):
+        '''Collide "geom", which has no object, such as a level bound, with
+        "material".
+        '''
+        self.materials[geom] = material
+
+    def get_parameters(self, geom1, geom2):
+        '''Return the (mode, mu, bounce) used for contacts of this pair.'''
+        material1 = self.materials.get(geom1, DEFAULT_MATERIAL)
+        material2 = self.materials.get(geom2, DEFAULT_MATERIAL)
+        try:
+            return self.table[material1, material2]
+        except KeyError:
+            return material1.combine(material2)
+
+    def add_pair(self, geom1, geom2):
+        body1 = geom1.getBody()
+        body2 = geom2.getBody()
+        if body1 is None and body2 is None:
+            pair = None
+        else:
+            pair = (body1, body2) + self.get_parameters(geom1, geom2)
+        self.pairs[geom1, geom2] = pair
+        return pair
+
+    def near_callback(self, args, geom1, geom2):
+        try:
+            pair = self.pairs[geom1, geom2]
+        except KeyError:
+            pair = self.add_pair(geom1, geom2)
+        if pair is None:
+            self.skipped += 1
+            return
+
+        body1, body2, mode, mu, bounce = pair
+        if ((body1 is None or not body1.isEnabled()) and
+            (body2 is None or not body2.isEnabled())):
+            self.sleeping += 1
+            return
+
+        world, contactgroup = self.world, self.contactgroup
+        contacts = ode.collide(geom1, geom2)
+        for contact in contacts:
+            contact.setMode(mode)
+            contact.setMu(mu)
+            contact.setBounce(bounce)
+            ode.ContactJoint(world, contactgroup, contact).attach(body1, body2)
+        self.contacts += len(contacts)
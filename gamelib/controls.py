@@ -0,0 +1,51 @@
+'''Player controls.
+
+Key events only set and clear bits in a KeyState; the physics loop polls it
+once per step, so input costs the same however fast keys are mashed, and
+nothing is ever scheduled on the clock for it.
+'''
+
+from replay import INPUT_LEFT, INPUT_RIGHT
+
+DIRECTIONS = {INPUT_LEFT: 'left', INPUT_RIGHT: 'right'}
+
+class KeyState(object):
+    '''A bitmap of the bound keys held down.
+
+    "bindings" maps key symbols to bits. When both directions are held, the
+    one pressed last wins until it's let go.
+    '''
+    def __init__(self, bindings):
+        self.bindings = bindings
+        self.bits = 0
+        self.last = 0 # Bit of the key pressed most recently
+        self.direction = None # What the physics loop polls
+
+    def press(self, symbol):
+        '''Mark "symbol" as held; returns whether it's bound.'''
+        bit = self.bindings.get(symbol, 0)
+        if not bit:
+            return False
+        self.bits |= bit
+        self.last = bit
+        self.update_direction()
+        return True
+
+    def release(self, symbol):
+        bit = self.bindings.get(symbol, 0)
+        if not bit:
+            return False
+        self.bits &= ~bit
+        self.update_direction()
+        return True
+
+    def clear(self):
+        '''Let go of everything, e.g. when the window loses focus.'''
+        self.bits = 0
+        self.direction = None
+
+    def update_direction(self):
+        bits = self.bits & (INPUT_LEFT | INPUT_RIGHT)
+        if bits & self.last:
+            bits = self.last
+        self.direction = DIRECTIONS.get(bits)
@@ -2,13 +2,36 @@
 
 Loads data files from the "data" directory shipped with a game.
 
-Enhancing this to handle caching etc. is left as an exercise for the reader.
+Images, text and sounds loaded through load_image(), load_text() and
+load_sound() are memoized by the SHA-1 of their contents: the most recently
+used are kept in an LRU cache of CACHE_SIZE bytes, and any still referenced
+elsewhere are shared through weak references, so the same asset is never
+decoded twice while it's in use, even under two names. Decoded image pixels
+are also kept in the cache directory, so later runs skip PNG decoding too.
+File hashes are only worked out again when a file's mtime or size changes;
+new ones are written out by save_hashes(), after loading a batch of assets,
+and when the game exits.
+Assets can be loaded from any thread; only the caches are locked, so decoding
+on several threads at once runs in parallel.
 '''
 
+import atexit
+import cPickle as pickle
+import hashlib
 import os
+import struct
+import threading
+import weakref
+
+import pyglet
 
 data_py = os.path.abspath(os.path.dirname(__file__))
 data_dir = os.path.normpath(os.path.join(data_py, '..', 'data'))
+cache_dir = os.path.join(data_dir, '.cache')
+
+CACHE_SIZE = 64 * 1024 * 1024 # Bytes of decoded assets kept in memory
+PIXELS_HEADER = struct.Struct('>BII') # version, width, height
+PIXELS_VERSION = 1
 
 def filepath(filename):
     '''Determine the path to a file in the data directory.
@@ -22,3 +45,223 @@ def load(filename, mode='rb'):
     '''
     return open(os.path.join(data_dir, filename), mode)
 
+def cachepath(filename):
+    '''Determine the path to a file in the cache directory, creating the
+    directory if needed.
+    '''
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return os.path.join(cache_dir, filename)
+
+def image_size(filename):
+    '''Read the (width, height) of a PNG in the data directory.
+
+    Only the PNG header is parsed, so this works without a GL context.
+    '''
+    f = load(filename)
+    try:
+        header = f.read(24)
+    finally:
+        f.close()
+    if header[:8] != '\x89PNG\r\n\x1a\n' or header[12:16] != 'IHDR':
+        raise ValueError('%s is not a PNG file' % filename)
+    return struct.unpack('>II', header[16:24])
+
+class LRUCache(object):
+    '''Keeps the most recently used values, up to "max_size" in total.'''
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = {} # key -> [value, size, last use]
+        self.uses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.uses += 1
+        entry[2] = self.uses
+        return entry[0]
+
+    def put(self, key, value, size):
+        if key in self.entries:
+            self.size -= self.entries[key][1]
+        self.uses += 1
+        self.entries[key] = [value, size, self.uses]
+        self.size += size
+
+        # Always keep the newest value, however big
+        entries = self.entries
+        while self.size > self.max_size and len(entries) > 1:
+            oldest = min(entries, key=lambda key: entries[key][2])
+            self.size -= entries.pop(oldest)[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+_cache = LRUCache(CACHE_SIZE)
+_shared = weakref.WeakValueDictionary() # Assets in use, by (kind, hash)
+_hashes = None # filename -> (mtime, size, hash), loaded when first needed
+_hashes_changed = False # Whether _hashes has entries not yet saved
+_lock = threading.RLock() # Guards the four above
+
+def _load_hashes():
+    try:
+        f = open(cachepath('hashes'), 'rb')
+    except (IOError, OSError):
+        return {}
+    try:
+        try:
+            return pickle.load(f)
+        except Exception:
+            return {}
+    finally:
+        f.close()
+
+def save_hashes():
+    '''Write out the file hashes worked out since they were last saved.'''
+    global _hashes_changed
+    _lock.acquire()
+    try:
+        if not _hashes_changed:
+            return
+        _hashes_changed = False
+        try:
+            f = open(cachepath('hashes'), 'wb')
+        except (IOError, OSError):
+            return # A read-only install just hashes the files every run
+        try:
+            pickle.dump(_hashes, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+    finally:
+        _lock.release()
+
+atexit.register(save_hashes)
+
+def get_hash(filename):
+    '''Return the SHA-1 of a file in the data directory.
+
+    The file is only read again when its mtime or size has changed.
+    '''
+    global _hashes, _hashes_changed
+    stat = os.stat(filepath(filename))
+    _lock.acquire()
+    try:
+        if _hashes is None:
+            _hashes = _load_hashes()
+        entry = _hashes.get(filename)
+    finally:
+        _lock.release()
+    if entry is not None and entry[:2] == (stat.st_mtime, stat.st_size):
+        return entry[2]
+
+    f = load(filename)
+    try:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    finally:
+        f.close()
+    _lock.acquire()
+    try:
+        _hashes[filename] = (stat.st_mtime, stat.st_size, digest)
+        _hashes_changed = True
+    finally:
+        _lock.release()
+    return digest
+
+def _get_cached(key):
+    _lock.acquire()
+    try:
+        asset = _cache.get(key)
+        if asset is None:
+            asset = _shared.get(key)
+        return asset
+    finally:
+        _lock.release()
+
+def _add_cached(key, asset, size, shared=True):
+    _lock.acquire()
+    try:
+        if shared:
+            _shared[key] = asset
+        _cache.put(key, asset, size)
+    finally:
+        _lock.release()
+
+def _load_pixels(digest):
+    try:
+        f = open(cachepath(digest + '.pixels'), 'rb')
+    except (IOError, OSError):
+        return None
+    try:
+        header = f.read(PIXELS_HEADER.size)
+        if len(header) != PIXELS_HEADER.size:
+            return None
+        version, width, height = PIXELS_HEADER.unpack(header)
+        pixels = f.read()
+    finally:
+        f.close()
+    if version != PIXELS_VERSION or len(pixels) != width * height * 4:
+        return None
+    return pyglet.image.ImageData(width, height, 'RGBA', pixels)
+
+def _save_pixels(digest, image):
+    try:
+        f = open(cachepath(digest + '.pixels'), 'wb')
+    except (IOError, OSError):
+        return
+    try:
+        f.write(PIXELS_HEADER.pack(PIXELS_VERSION, image.width,
+                                   image.height))
+        f.write(image.get_data('RGBA', image.width * 4))
+    finally:
+        f.close()
+
+def load_image(filename):
+    '''Return a file in the data directory as decoded pyglet ImageData.
+
+    The image is shared with every other caller, so don't change it; to
+    give it an anchor, take a region of its texture.
+    '''
+    key = ('image', get_hash(filename))
+    image = _get_cached(key)
+    if image is None:
+        image = _load_pixels(key[1])
+        if image is None:
+            image = pyglet.image.load(filepath(filename)).get_image_data()
+            _save_pixels(key[1], image)
+    _add_cached(key, image, image.width * image.height * 4)
+    return image
+
+def load_text(filename):
+    '''Return the contents of a text file in the data directory.'''
+    key = ('text', get_hash(filename))
+    text = _get_cached(key)
+    if text is None:
+        f = load(filename, 'r')
+        try:
+            text = f.read()
+        finally:
+            f.close()
+        # Strings can't be weakly referenced, so they're only in the LRU
+        _add_cached(key, text, len(text), shared=False)
+    return text
+
+def load_sound(filename):
+    '''Return a sound in the data directory, decoded into memory.'''
+    key = ('sound', get_hash(filename))
+    sound = _get_cached(key)
+    if sound is None:
+        sound = pyglet.media.load(filepath(filename), streaming=False)
+        _add_cached(key, sound, os.path.getsize(filepath(filename)))
+    return sound
+
+def clear_cache():
+    '''Forget every asset kept in memory.'''
+    _lock.acquire()
+    try:
+        _cache.clear()
+        _shared.clear()
+    finally:
+        _lock.release()
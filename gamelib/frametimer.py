@@ -0,0 +1,100 @@
+'''Named timers for the phases of a frame.
+
+Each phase of the game loop is wrapped in start() and stop(); end_frame()
+files the frame's totals in a ring of the last HISTORY_FRAMES frames and,
+if a trace is open, writes them out as a line of CSV.
+'''
+
+import timeit
+
+HISTORY_FRAMES = 300
+
+# time.clock on Windows, where time.time only ticks every 15.6 ms or so
+timer = timeit.default_timer
+
+def _csv_row(frame, frame_time, times):
+    return '%d,%f,%s\n' % (frame, frame_time,
+                           ','.join(['%f' % t for t in times]))
+
+class FrameTimer(object):
+    def __init__(self, names, history=HISTORY_FRAMES):
+        self.names = tuple(names)
+        self.current = dict.fromkeys(self.names, 0.0)
+        self.started = {}
+        self.frames = 0
+        self.last_frame = timer()
+
+        # Ring of (frame time, phase times) tuples, oldest first once full
+        self.history = [None] * history
+        self.trace = None
+
+    def start(self, name):
+        self.started[name] = timer()
+
+    def stop(self, name):
+        self.current[name] += timer() - self.started.pop(name)
+
+    def end_frame(self):
+        '''File the timings of the frame that just ended and start anew.'''
+        now = timer()
+        frame_time = now - self.last_frame
+        self.last_frame = now
+
+        times = tuple([self.current[name] for name in self.names])
+        self.history[self.frames % len(self.history)] = (frame_time, times)
+        self.frames += 1
+        if self.trace is not None:
+            self.trace.write(_csv_row(self.frames, frame_time, times))
+        for name in self.names:
+            self.current[name] = 0.0
+
+    def get_history(self):
+        '''Return the recorded frames, oldest first.'''
+        if self.frames < len(self.history):
+            return self.history[:self.frames]
+        index = self.frames % len(self.history)
+        return self.history[index:] + self.history[:index]
+
+    def get_averages(self, frames=60):
+        '''Return the mean frame time and mean time of each phase, in
+        seconds, over the last "frames" frames.
+        '''
+        history = self.get_history()[-frames:]
+        if not history:
+            return 0.0, dict.fromkeys(self.names, 0.0)
+        frame_time = sum([frame[0] for frame in history]) / len(history)
+        averages = {}
+        for index, name in enumerate(self.names):
+            averages[name] = (sum([frame[1][index] for frame in history]) /
+                              len(history))
+        return frame_time, averages
+
+    def format(self, frames=60):
+        '''Return the averages as lines of text, in milliseconds.'''
+        frame_time, averages = self.get_averages(frames)
+        lines = ['%-10s %6.2f ms' % ('frame', frame_time * 1000)]
+        for name in self.names:
+            lines.append('%-10s %6.2f ms' % (name, averages[name] * 1000))
+        return '\n'.join(lines)
+
+    def open_trace(self, filename):
+        '''Write every frame's timings to "filename" as CSV.'''
+        self.close_trace()
+        self.trace = open(filename, 'w')
+        self.trace.write('frame,frame_time,%s\n' % ','.join(self.names))
+
+    def close_trace(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+    def save(self, filename):
+        '''Write the frames in the ring to "filename" as CSV.'''
+        f = open(filename, 'w')
+        try:
+            f.write('frame,frame_time,%s\n' % ','.join(self.names))
+            first = self.frames - len(self.get_history()) + 1
+            for index, (frame_time, times) in enumerate(self.get_history()):
+                f.write(_csv_row(first + index, frame_time, times))
+        finally:
+            f.close()
@@ -1,21 +1,34 @@
 #!/usr/bin/env python
+import sys
+import time
+
 import data
 import pyglet
-import ode
 
+import camera
 import console
-import physics
+import controls
+import frametimer
+import hud
+import level
+import replay
+import screenshot
+import simulation
+import spritesync
+import tiles
+from simulation import PHYSICS_STEP
 
 # Gameplay constants
-BENCHMARK = False
 DISPLAY_FPS = False
-GRAVITY = -100.0
-PHYSICS_STEP = 0.0025
 FPS_LIMIT = 0 # 0 for no limit
-PLAYER_SPEED = 5.0
-PLAYER_SPEED_STEP = 1.0
-PLAYER_SPEED_TIME = 25.0 # The amount of times speed is updated per second
+MAX_PHYSICS_STEPS = 40 # Most physics steps run in a single frame
+PHYSICS_TIME_BUDGET = 0.05 # Most seconds spent stepping physics per frame
 CONSOLE_SPEED = 0.25
+REPLAY_FILE = 'replay.rec'
+SCREENSHOT_FILE = 'screenshot.png'
+BURST_FILE = 'screenshot-%04d.png' # Numbered files for SHIFT+F5
+BURST_FRAMES = 60
+TIMINGS_INTERVAL = 0.5 # Seconds between refreshes of the timing overlay
 
 gameover = False
 
@@ -24,62 +37,36 @@ window = pyglet.window.Window(800, 600)
 #window.set_fullscreen(True)
 batch = pyglet.graphics.Batch()
 
-# Set up ODE
-world = ode.World()
-world.setGravity((0, GRAVITY, 0))
-world.setERP(0.8)
-space = ode.Space()
-contactgroup = ode.JointGroup()
-
-# Background sprite
-background = pyglet.sprite.Sprite(pyglet.image.load(
-        data.filepath('background.png')))
-
-# Physics limits
-roof = ode.GeomPlane(space, (0, -1, 0), -background.height)
-floor = ode.GeomPlane(space, (0, 1, 0), 0)
-wall_left = ode.GeomPlane(space, (1, 0, 0), 0)
-wall_right = ode.GeomPlane(space, (-1, 0, 0), -background.width)
-
-# Player
-class Player(physics.PhysicsCylinder):
-    def __init__(self):
-        super(Player, self).__init__(world, space, 'yarn.png', batch)
-        self.speed_dt = 0
-
-        self.start_position = (200, 900, 0)
-        self.body.setPosition(self.start_position)
-
-    def reset(self):
-        self.body.setAngularVel((0, 0, 0))
-        self.body.setLinearVel((0, 0, 0))
-        self.body.setPosition(self.start_position)
-
-    def move_left(self, dt):
-        self.update_speed(dt, 'left')
-
-    def move_right(self, dt):
-        self.update_speed(dt, 'right')
-
-    def update_speed(self, dt, direction):
-        zspeed = self.body.getAngularVel()[2]
-        if direction == 'left' and zspeed < PLAYER_SPEED:
-            zspeed = min(PLAYER_SPEED, zspeed + PLAYER_SPEED_STEP *
-                         PLAYER_SPEED_TIME * dt)
-        elif direction == 'right' and zspeed > -PLAYER_SPEED:
-            zspeed = max(-PLAYER_SPEED, zspeed - PLAYER_SPEED_STEP *
-                          PLAYER_SPEED_TIME * dt)
-        self.body.setAngularVel((0, 0, zspeed))
-
-player = Player()
+# Level data, with every prop image decoded up front
+current_level = level.load(level.FIRST_LEVEL)
+
+# Level sprites are drawn in world coordinates, scrolled by the camera
+world_camera = camera.Camera()
+
+# Background tiles, streamed in around the camera
+background_batch = pyglet.graphics.Batch()
+background = tiles.TiledBackground(current_level.background,
+                                   background_batch, world_camera)
+
+# Set up the simulation (ODE world, level bounds and player)
+sim = simulation.Simulation(current_level, batch, group=world_camera)
+world = sim.world
+space = sim.space
+static_space = sim.static_space
+contactgroup = sim.contactgroup
+player = sim.player
 
 # Console
 window_console = console.Console(window, globals())
 
+# Time spent in each phase of a frame, see toggle_timings()
+frame_timer = frametimer.FrameTimer(('input', 'physics', 'sync', 'draw',
+                                     'labels'))
+
 # Static overlay
 class Overlay(object):
     def __init__(self, filename, position, batch=None):
-        self.image = pyglet.image.load(data.filepath(filename))
+        self.image = data.load_image(filename)
         self.sprite = pyglet.sprite.Sprite(self.image, batch=batch)
         self.position = position
 
@@ -89,16 +76,6 @@ class Overlay(object):
     def getSprite(self):
         return self.sprite
 
-# Physics
-def near_callback(args, geom1, geom2):
-    contacts = ode.collide(geom1, geom2)
-    for contact in contacts:
-        contact.setMode(ode.ContactBounce)
-        contact.setMu(ode.Infinity)
-        contact.setBounce(0.5)
-        joint = ode.ContactJoint(world, contactgroup, contact)
-        joint.attach(geom1.getBody(), geom2.getBody())
-
 # Input
 @window.event
 def on_text(text):
@@ -112,6 +89,17 @@ def on_text_motion(motion):
 
 @window.event
 def on_key_press(symbol, modifiers):
+    frame_timer.start('input')
+    handle_key_press(symbol, modifiers)
+    frame_timer.stop('input')
+
+@window.event
+def on_key_release(symbol, modifiers):
+    frame_timer.start('input')
+    handle_key_release(symbol, modifiers)
+    frame_timer.stop('input')
+
+def handle_key_press(symbol, modifiers):
     key = pyglet.window.key
 
     if gameover and not symbol in [key.RETURN, key.GRAVE]:
@@ -122,181 +110,230 @@ def on_key_press(symbol, modifiers):
         window_console.toggle()
         return
     elif window_console.is_active():
+        window_console.on_key_press(symbol, modifiers)
         return
 
-    if symbol == key.LEFT:
-        pyglet.clock.schedule_interval(player.move_left,
-                                       1.0 / PLAYER_SPEED_TIME)
-    elif symbol == key.RIGHT:
-        pyglet.clock.schedule_interval(player.move_right,
-                                       1.0 / PLAYER_SPEED_TIME)
+    if key_state.press(symbol):
+        return
     elif symbol == key.F5:
-        color_buffer = pyglet.image.get_buffer_manager().get_color_buffer()
-        color_buffer.save('screenshot.png')
+        if modifiers & key.MOD_SHIFT:
+            screenshots.burst(BURST_FRAMES, BURST_FILE)
+        else:
+            screenshots.capture(SCREENSHOT_FILE)
+    elif symbol == key.F6:
+        toggle_recording()
     elif symbol == key.RETURN:
-        for physics in level_physics:
-            space.remove(physics.getGeom())
+        stop_recording()
         create_first_level()
-        player.reset()
+
+def handle_key_release(symbol, modifers):
+    key_state.release(symbol)
 
 @window.event
-def on_key_release(symbol, modifers):
-    key = pyglet.window.key
+def on_deactivate():
+    key_state.clear()
+
+# Player input, polled by the physics loop once per step
+key_state = controls.KeyState({pyglet.window.key.LEFT: replay.INPUT_LEFT,
+                               pyglet.window.key.RIGHT: replay.INPUT_RIGHT})
+scripted_input = None # A replay or timeline played instead of the keyboard
+
+def get_direction():
+    if scripted_input is not None:
+        return scripted_input.direction_at(sim.steps * PHYSICS_STEP)
+    return key_state.direction
+
+# Recording restarts the level so the replay starts from a known state
+def toggle_recording():
+    if sim.recorder is None:
+        create_first_level()
+        sim.recorder = replay.Recorder()
+    else:
+        stop_recording()
 
-    if symbol == key.LEFT:
-        pyglet.clock.unschedule(player.move_left)
-    elif symbol == key.RIGHT:
-        pyglet.clock.unschedule(player.move_right)
+def stop_recording():
+    if sim.recorder is not None:
+        sim.recorder.save(REPLAY_FILE)
+        sim.recorder = None
 
 # Levels 
 level_physics = []
 level_overlays = []
+sprite_sync = spritesync.SpriteSync()
 time_left = 0.0
 def create_first_level():
     global time_left, level_physics, level_overlays, gameover
 
-    level_physics = []
+    sim.reset()
+    level_physics = sim.level_physics
+    sprite_sync.set_objects(level_physics)
     level_overlays = []
     gameover = False
-    
-    box1 = physics.PhysicsBox(world, space, 'box1.png', batch)
-    box1.getBody().setPosition((220, 155, 0))
-    level_physics.append(box1)
-    
-    box2 = physics.PhysicsBox(world, space, 'box2.png', batch)
-    box2.getBody().setPosition((220, 492.5, 0))
-    level_physics.append(box2)
-    
-    box3 = physics.PhysicsBox(world, space, 'box3.png', batch)
-    box3.getBody().setPosition((220, 748, 0))
-    level_physics.append(box3)
-    
-    phone = physics.StaticBox(space, 'phone.png', batch)
-    phone.setPosition((730, 70, 0))
-    level_physics.append(phone)
-
-    stapler_bottom = physics.StaticBox(space, 'stapler_bottom.png', batch)
-    stapler_bottom.setPosition((1364.5, 44.5, 0))
-    level_physics.append(stapler_bottom)
-
-    stapler_top = physics.StaticBox(space, 'stapler_top.png', batch)
-    stapler_top.setPosition((1282.5, 250, 0))
-    stapler_top.setRotation(50)
-    level_physics.append(stapler_top)
-
-    ruler = physics.StaticBox(space, 'ruler.png', batch)
-    ruler.setPosition((1750, 250, 0))
-    ruler.setRotation(70)
-    level_physics.append(ruler)
-
-    monitor = physics.StaticBox(space, 'monitor.png', batch)
-    monitor.setPosition((2050, 205, 0))
-    level_physics.append(monitor)
-
-    donuts_bottom = physics.StaticBox(space, 'donuts_bottom.png', batch)
-    donuts_bottom.setPosition((2625.5, 20, 0))
-    level_physics.append(donuts_bottom)
-
-    donuts_top = physics.StaticBox(space, 'donuts_top.png', batch)
-    donuts_top.setPosition((2485.5, 170, 0))
-    level_physics.append(donuts_top)
-    time_left = 25.0
+    time_left = sim.level.time
 
 # Main
 def get_window_position(position, offset):
     return position[0] + offset[0], position[1] + offset[1]
 
-time_display = pyglet.text.Label(font_size=22, color=(0, 0, 0, 128),
-                                 anchor_x="center", anchor_y="center",
-                                 x=window.width / 2, y=window.height / 2 - 100)
+time_display = hud.CounterLabel("%d seconds remaining", font_size=22,
+                                color=(0, 0, 0, 128),
+                                anchor_x="center", anchor_y="center",
+                                x=window.width / 2, y=window.height / 2 - 100)
+
+gameover_display = hud.CachedLabel(font_size=22, color=(0, 0, 0, 128),
+                                   anchor_x="center", anchor_y="center",
+                                   x=window.width / 2,
+                                   y=window.height / 2 + 100)
+
+timing_display = pyglet.text.Label(font_name='Courier New', font_size=10,
+                                   color=(0, 0, 0, 192), multiline=True,
+                                   width=200, anchor_y="top",
+                                   x=10, y=window.height - 10)
+
+# Timing overlay, for typing into the console
+show_timings = False
+def toggle_timings():
+    '''Show or hide the average time spent in each phase of a frame.
+
+    Use frame_timer.open_trace(filename) to also write every frame's
+    timings to a CSV file, or frame_timer.save(filename) for the last few
+    seconds.
+    '''
+    global show_timings
+    show_timings = not show_timings
+    if show_timings:
+        update_timings(0)
+        pyglet.clock.schedule_interval(update_timings, TIMINGS_INTERVAL)
+    else:
+        pyglet.clock.unschedule(update_timings)
 
-gameover_display = pyglet.text.Label(font_size=22, color=(0, 0, 0, 128),
-                                     anchor_x="center", anchor_y="center",
-                                     x=window.width / 2,
-                                     y=window.height / 2 + 100)
+def update_timings(dt):
+    timing_display.text = frame_timer.format()
 
+# Physics
 physics_dt = 0.0
+dropped_time = 0.0 # Simulation time skipped because frames were too slow
+dropped_frames = 0
+def step_physics(dt):
+    '''Run the physics steps due this frame.
+
+    At most MAX_PHYSICS_STEPS steps, or PHYSICS_TIME_BUDGET seconds of
+    stepping, are run; time beyond that is dropped rather than carried over,
+    so a slow frame can't make the next one slower still. Returns how far
+    (0 to 1) the simulation is between its last two steps, for interpolating
+    what is drawn.
+    '''
+    global physics_dt, dropped_time, dropped_frames
+
+    physics_dt += dt
+    steps = min(int(physics_dt / PHYSICS_STEP), MAX_PHYSICS_STEPS)
+    deadline = time.time() + PHYSICS_TIME_BUDGET
+
+    # ODE recomends constant world steps to stop jitter
+    for step in xrange(steps):
+        last = step == steps - 1 or time.time() > deadline
+        if last:
+            sim.save_state()
+        sim.step(get_direction())
+        physics_dt -= PHYSICS_STEP
+        if last:
+            break
+
+    if physics_dt >= PHYSICS_STEP:
+        skipped = physics_dt - physics_dt % PHYSICS_STEP
+        dropped_time += skipped
+        dropped_frames += 1
+        physics_dt -= skipped
+
+    return physics_dt / PHYSICS_STEP
+
 def update(dt):
     global time_left, gameover
-    time_left -= dt
-    time_display.text = "%d seconds remaining" % (time_left)
+    frame_timer.start('physics')
+    steps = sim.steps
+    alpha = step_physics(dt)
+    frame_timer.stop('physics')
+
+    # Only the time simulated counts down, not time dropped by step_physics
+    time_left -= (sim.steps - steps) * PHYSICS_STEP
+    frame_timer.start('labels')
+    time_display.set_value(time_left)
+    frame_timer.stop('labels')
 
     if not gameover and time_left <= 0:
         gameover_display.text = "Gameover, press ENTER to restart"
         gameover = True
         #return
-    elif not gameover and player.getBody().getPosition()[0] > 3600:
+    elif not gameover and sim.has_won():
         gameover_display.text = "You won! Press ENTER to play again"
         gameover = True
 
-    player.update()
+    frame_timer.start('sync')
+    player.update(alpha)
  
     # Position everything but try to keep player in the middle of the screen
-    player_pos = player.body.getPosition()[0:2]
+    player_pos = player.getInterpolatedPosition(alpha)[0:2]
     player_offset = (window.width / 2 - player_pos[0],
                      window.height / 2 - player_pos[1])
     window_offset = [0, 0]
     if player_offset[0] > 0:
         window_offset[0] = player_offset[0]
-    elif player_offset[0] < -(background.image.width - window.width):
-        window_offset[0] = (background.image.width - window.width +
+    elif player_offset[0] < -(background.width - window.width):
+        window_offset[0] = (background.width - window.width +
                             player_offset[0])
 
     if player_offset[1] > 0:
         window_offset[1] = player_offset[1]
-    elif player_offset[1] < -(background.image.height - window.height):
-        window_offset[1] = (background.image.height - window.height +
+    elif player_offset[1] < -(background.height - window.height):
+        window_offset[1] = (background.height - window.height +
                             player_offset[1])
 
     object_offset = (player_offset[0] - window_offset[0],
                      player_offset[1] - window_offset[1])
+    world_camera.offset = object_offset
 
-    player.sprite.x, player.sprite.y = (window.width / 2 - window_offset[0],
-                                        window.height / 2 - window_offset[1])
-    background.position = object_offset
+    player.sprite.position = player_pos
 
-    # Convert world positions to screen positions
-    for physics in level_physics:
-        physics.update()
-        physics.getSprite().position = get_window_position(physics.getPosition(),
-                                                           object_offset)
+    # Place the moving sprites, skipping those off screen
+    view = world_camera.get_view(window.width, window.height)
+    background.update(view)
+    sprite_sync.sync(alpha, view)
 
     for overlay in level_overlays:
         overlay.getSprite().position = get_window_position(
             overlay.position, object_offset)
-
-    # Physics
-    global physics_dt
-
-    physics_dt += dt
-    # ODE recomends constant world steps to stop jitter
-    while physics_dt > PHYSICS_STEP:
-        space.collide(None, near_callback)
-        world.step(PHYSICS_STEP)
-        contactgroup.empty()
-
-        physics_dt -= PHYSICS_STEP
+    frame_timer.stop('sync')
 
 # Graphics
 if DISPLAY_FPS:
     fps_display = pyglet.clock.ClockDisplay()
 
+screenshots = screenshot.Screenshots()
+
 @window.event
 def on_draw():
     window.clear()
-    background.draw()
+    frame_timer.start('draw')
+    background_batch.draw()
     batch.draw()
+    frame_timer.stop('draw')
+
+    frame_timer.start('labels')
     if not gameover:
         time_display.draw()
     else:
         gameover_display.draw()
+    if show_timings:
+        timing_display.draw()
+    frame_timer.stop('labels')
 
-    if window_console.is_active():
-        window_console.layout.draw()
+    window_console.draw()
 
     if DISPLAY_FPS:
         fps_display.draw()
 
+    screenshots.update(window.width, window.height)
+    frame_timer.end_frame()
     pyglet.clock.tick()
 
 # Intialisation
@@ -306,15 +343,51 @@ def main():
     pyglet.clock.set_fps_limit(FPS_LIMIT)
     pyglet.clock.schedule(update)
     pyglet.app.run()
+    screenshots.close()
+
+def run_session(script, duration, frame_rate=60.0, draw=False):
+    '''Play "duration" seconds of the first level as fast as possible, with
+    input from "script" (anything with a direction_at(time) method).
+
+    Every frame goes through update(), sprite syncing included, with a fixed
+    frame time so the timings are comparable between builds. Frames are
+    only drawn if "draw" is set. Returns (frames, elapsed seconds).
+    '''
+    global scripted_input
+
+    scripted_input = script
+    script.rewind()
+    create_first_level()
+    steps = int(duration / PHYSICS_STEP + 0.5)
+
+    frames = 0
+    start = time.time()
+    while sim.steps < steps:
+        update(1.0 / frame_rate)
+        if draw:
+            window.dispatch_event('on_draw')
+            window.flip()
+        else:
+            frame_timer.end_frame()
+        frames += 1
+    elapsed = time.time() - start
+
+    scripted_input = None
+    return frames, elapsed
+
+def playback(filename, frame_rate=60.0):
+    '''Replay a recording as fast as possible with rendering turned off.'''
+    recording = replay.Replay.load(filename)
+    frames, elapsed = run_session(recording, recording.get_duration(),
+                                  frame_rate)
+
+    print '%d frames, %d steps in %.3f seconds' % (frames, sim.steps, elapsed)
+    print '%.1f frames/s, %.1fx real time' % (
+        frames / elapsed, recording.get_duration() / elapsed)
+    print frame_timer.format(frames)
 
 if __name__ == "__main__":
-    if BENCHMARK:
-        import hotshot, hotshot.stats
-        prof = hotshot.Profile("benchmark.prof")
-        prof.runcall(main)
-        prof.close()
-        stats = hotshot.stats.load("benchmark.prof")
-        stats.sort_stats('time', 'calls')
-        stats.print_stats(20)
+    if len(sys.argv) > 1:
+        playback(sys.argv[1])
     else:
         main()
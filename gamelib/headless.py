@@ -0,0 +1,180 @@
+'''Headless simulation runner.
+
+Steps the game physics without opening a window, driven by a scripted input
+timeline, and reports the physics throughput in steps per second.
+
+Instead of a timeline, a recording made in the game (see replay.py) can be
+played back as fast as the physics allows.
+
+Timeline files have one event per line: a time in seconds followed by the
+direction held from then on ("left", "right" or "none"). Blank lines and
+lines starting with "#" are ignored.
+'''
+
+import optparse
+import sys
+import time
+
+import contacts
+import level
+import physics
+import replay
+import simulation
+from simulation import PHYSICS_STEP
+
+class Timeline(object):
+    def __init__(self, events=None):
+        if events is None:
+            events = [(0.0, 'right')]
+        self.events = sorted(events)
+        self.index = 0
+
+    def rewind(self):
+        self.index = 0
+
+    def direction_at(self, t):
+        '''Return the direction held at time "t".
+
+        Times must be asked for in increasing order (until rewind() is
+        called), which keeps the lookup constant time per step.
+        '''
+        events = self.events
+        while self.index + 1 < len(events) and events[self.index + 1][0] <= t:
+            self.index += 1
+        if not events or events[self.index][0] > t:
+            return None
+        return events[self.index][1]
+
+    @classmethod
+    def load(cls, filename):
+        events = []
+        f = open(filename, 'r')
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            when, direction = line.split()
+            if direction == 'none':
+                direction = None
+            elif direction not in ('left', 'right'):
+                raise ValueError('Unknown direction %r' % direction)
+            events.append((float(when), direction))
+        f.close()
+        return cls(events)
+
+def create_simulation(contact_handler=contacts.ContactManager,
+                      name=level.FIRST_LEVEL):
+    '''Build a Simulation of a level, without any graphics.'''
+    physics.HEADLESS = True
+    sim = simulation.Simulation(level.load(name, headless=True),
+                                contact_handler=contact_handler)
+    sim.reset()
+    return sim
+
+def run(duration=None, timeline=None, sim=None):
+    '''Simulate "duration" seconds of play and return (sim, elapsed).
+
+    "timeline" is anything with a direction_at(time) method, such as a
+    Timeline or a replay.Replay. The duration defaults to the level's time
+    limit.
+    '''
+    if timeline is None:
+        timeline = Timeline()
+    if sim is None:
+        sim = create_simulation()
+    if duration is None:
+        duration = sim.level.time
+
+    steps = int(duration / PHYSICS_STEP + 0.5)
+
+    start = time.time()
+    for step in xrange(steps):
+        sim.step(timeline.direction_at(sim.steps * PHYSICS_STEP))
+    elapsed = time.time() - start
+
+    return sim, elapsed
+
+def compare_contacts(duration=None, timeline=None, name=level.FIRST_LEVEL):
+    '''Print contacts handled per second by each contact handler.'''
+    for handler in (contacts.ContactHandler, contacts.ContactManager):
+        if timeline is not None:
+            timeline.rewind()
+        sim = create_simulation(handler, name)
+        sim, elapsed = run(duration, timeline, sim)
+        print '%s: %d contacts in %.3f seconds (%.0f contacts/s)' % (
+            handler.__name__, sim.contacts.contacts, elapsed,
+            sim.contacts.contacts / max(elapsed, 1e-9))
+
+def check_rollback(duration=None, timeline=None, name=level.FIRST_LEVEL):
+    '''Check that rolling back to a snapshot and simulating the same input
+    again ends in exactly the same state. Returns True if it does.
+    '''
+    if timeline is None:
+        timeline = Timeline()
+    sim = create_simulation(name=name)
+    if duration is None:
+        duration = sim.level.time
+
+    run(duration / 2, timeline, sim)
+    snapshot = sim.take_snapshot()
+    run(duration / 2, timeline, sim)
+    first = sim.take_snapshot().values
+
+    sim.restore_snapshot(snapshot)
+    timeline.rewind()
+    run(duration / 2, timeline, sim)
+    second = sim.take_snapshot().values
+
+    difference = max([abs(a - b) for a, b in zip(first, second)])
+    print 'Rolled back %d steps, largest difference afterwards: %g' % (
+        sim.steps - snapshot.steps, difference)
+    return first == second
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-d', '--duration', type='float',
+                      help='seconds of game time to simulate '
+                           '(default: the level time limit)')
+    parser.add_option('-l', '--level', default=level.FIRST_LEVEL,
+                      help='level to simulate')
+    parser.add_option('-t', '--timeline',
+                      help='input timeline file (default: hold right)')
+    parser.add_option('-r', '--replay',
+                      help='play back a recording instead of a timeline')
+    parser.add_option('-c', '--compare-contacts', action='store_true',
+                      help='benchmark the contact handlers against each other')
+    parser.add_option('--check-rollback', action='store_true',
+                      help='check that snapshot rollback is deterministic')
+    options, args = parser.parse_args()
+
+    timeline = None
+    duration = options.duration
+    if options.replay:
+        timeline = replay.Replay.load(options.replay)
+        duration = timeline.get_duration()
+    elif options.timeline:
+        timeline = Timeline.load(options.timeline)
+
+    if options.compare_contacts:
+        compare_contacts(duration, timeline, options.level)
+        return
+    if options.check_rollback:
+        if not check_rollback(duration, timeline, options.level):
+            sys.exit(1)
+        return
+
+    sim, elapsed = run(duration, timeline,
+                       create_simulation(name=options.level))
+    x, y = sim.player.getPosition()[0:2]
+    print '%d steps in %.3f seconds (%.0f steps/s)' % (
+        sim.steps, elapsed, sim.steps / max(elapsed, 1e-9))
+    print '%d contacts (%.0f contacts/s)' % (
+        sim.contacts.contacts, sim.contacts.contacts / max(elapsed, 1e-9))
+    print '%d of %d bodies asleep' % (
+        len([body for body in sim.bodies if body.isSleeping()]),
+        len(sim.bodies))
+    print 'Player finished at (%.1f, %.1f), won: %s' % (x, y,
+                                                       sim.has_won())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+'''Heads-up display text.
+
+Setting a Label's text lays the whole label out again and rebuilds its
+vertex lists, even when the text hasn't changed. CachedLabel skips
+assignments of the text it already shows. CounterLabel goes further for
+numbers that change all the time: each digit is a sprite showing a glyph
+from the font's texture atlas, so a new number only swaps texture
+coordinates, and the words around it are laid out once.
+'''
+
+import pyglet
+
+NUMBER_CHARACTERS = '-0123456789'
+
+class CachedLabel(pyglet.text.Label):
+    '''A Label that ignores assignments of the text it already shows.'''
+    def _set_text(self, text):
+        if text != self.document.text:
+            self.document.text = text
+
+    text = property(pyglet.text.Label._get_text, _set_text)
+
+class CounterLabel(object):
+    '''A line of text with one integer in it, such as "%d seconds left".'''
+    def __init__(self, text, font_name=None, font_size=None,
+                 color=(255, 255, 255, 255), x=0, y=0,
+                 anchor_x='left', anchor_y='baseline'):
+        self.batch = pyglet.graphics.Batch()
+        self.color = color
+        self.x = x
+        self.anchor_x = anchor_x
+
+        font = pyglet.font.load(font_name, font_size)
+        if anchor_y == 'baseline':
+            self.baseline = y
+        elif anchor_y == 'center':
+            self.baseline = y - (font.ascent + font.descent) / 2
+        elif anchor_y == 'top':
+            self.baseline = y - font.ascent
+        else:
+            self.baseline = y - font.descent
+        self.glyphs = dict(zip(NUMBER_CHARACTERS,
+                               font.get_glyphs(NUMBER_CHARACTERS)))
+
+        prefix, suffix = text.split('%d')
+        self.prefix = pyglet.text.Label(prefix, font_name, font_size,
+                                        color=color, y=self.baseline,
+                                        batch=self.batch)
+        self.suffix = pyglet.text.Label(suffix, font_name, font_size,
+                                        color=color, y=self.baseline,
+                                        batch=self.batch)
+        self.sprites = []
+        self.number = None
+        self.width = None
+
+    def set_value(self, value):
+        '''Show the integer "value"; costs nothing if it's already shown.'''
+        number = '%d' % value
+        if number == self.number:
+            return
+        self.number = number
+
+        while len(self.sprites) < len(number):
+            sprite = pyglet.sprite.Sprite(self.glyphs['0'], batch=self.batch)
+            sprite.color = self.color[0:3]
+            sprite.opacity = self.color[3]
+            self.sprites.append(sprite)
+        for index, sprite in enumerate(self.sprites):
+            sprite.visible = index < len(number)
+
+        glyphs = [self.glyphs[character] for character in number]
+        width = (self.prefix.content_width + self.suffix.content_width +
+                 sum([glyph.advance for glyph in glyphs]))
+        if width != self.width:
+            self.width = width
+            self.prefix.x = self.get_left()
+        pen = self.prefix.x + self.prefix.content_width
+        for sprite, glyph in zip(self.sprites, glyphs):
+            sprite.image = glyph
+            sprite.position = (pen + glyph.vertices[0],
+                               self.baseline + glyph.vertices[1])
+            pen += glyph.advance
+        if self.suffix.x != pen:
+            self.suffix.x = pen
+
+    def get_left(self):
+        if self.anchor_x == 'center':
+            return self.x - self.width / 2
+        elif self.anchor_x == 'right':
+            return self.x - self.width
+        return self.x
+
+    def draw(self):
+        self.batch.draw()
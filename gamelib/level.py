@@ -0,0 +1,175 @@
+'''Level loading.
+
+Levels are described by JSON files in the data directory (see level1.json):
+the player's start, the props with their positions, rotations and materials,
+and the materials themselves.
+
+Loading a level compiles it into a Level: every prop's geom dimensions are
+worked out and, unless running headless, every image is decoded through
+data.load_image(), which keeps the decoded pixels. Compiled levels are kept
+in memory and pickled into the data cache, so restarting or switching levels
+never parses a level or decodes a PNG twice.
+'''
+
+import cPickle as pickle
+import os
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import contacts
+import data
+
+FIRST_LEVEL = 'level1'
+CACHE_VERSION = 2
+
+PROP_TYPES = ('box', 'cylinder', 'static_box', 'static_cylinder')
+
+class Prop(object):
+    '''One object in a level, with its geom dimensions precomputed.'''
+    def __init__(self, kind, filename, position, rotation=0,
+                 material='default', size=None):
+        if kind not in PROP_TYPES:
+            raise ValueError('Unknown prop type %r' % kind)
+        self.kind = kind
+        self.filename = filename
+        self.position = (position[0], position[1], 0)
+        self.rotation = rotation
+        self.material = material
+        if size is None:
+            size = data.image_size(filename)
+        self.size = size
+
+    def is_static(self):
+        return self.kind.startswith('static_')
+
+class Level(object):
+    def __init__(self, name, time, end, background, player, props, materials):
+        self.name = name
+        self.time = time
+        self.end = end
+        self.background = background
+        self.size = data.image_size(background)
+        self.player = player
+        self.props = props
+        self.materials = materials
+
+        self.decoded = False # Headless levels never have images
+
+    def get_filenames(self):
+        filenames = [self.background, self.player.filename]
+        for prop in self.props:
+            if prop.filename not in filenames:
+                filenames.append(prop.filename)
+        return filenames
+
+    def get_image(self, filename):
+        '''Return the decoded image for "filename", or None when headless.'''
+        if not self.decoded:
+            return None
+        return data.load_image(filename)
+
+    def decode(self):
+        '''Decode every prop and player image (not the background).'''
+        for filename in self.get_filenames()[1:]:
+            data.load_image(filename)
+        data.save_hashes()
+        self.decoded = True
+
+def parse(name):
+    '''Read a level description from the data directory.'''
+    f = data.load(name + '.json', 'r')
+    try:
+        description = json.load(f)
+    finally:
+        f.close()
+
+    materials = {'default': (contacts.CONTACT_MU, contacts.CONTACT_BOUNCE)}
+    for material, values in description.get('materials', {}).items():
+        mu = values.get('mu', contacts.CONTACT_MU)
+        if mu == 'infinity':
+            mu = contacts.CONTACT_MU
+        bounce = values.get('bounce', contacts.CONTACT_BOUNCE)
+        materials[material] = (mu, bounce)
+
+    def make_prop(prop, kind):
+        material = prop.get('material', 'default')
+        if material not in materials:
+            raise ValueError('Unknown material %r' % material)
+        return Prop(kind, prop['image'], prop['position'],
+                    prop.get('rotation', 0), material)
+
+    return Level(name, description['time'], description['end'],
+                 description['background'],
+                 make_prop(description['player'], 'cylinder'),
+                 [make_prop(prop, prop['type'])
+                  for prop in description['props']],
+                 materials)
+
+def _get_sources(name, filenames):
+    '''Return what the compiled level depends on, to validate the cache.'''
+    sources = []
+    for filename in [name + '.json'] + filenames:
+        stat = os.stat(data.filepath(filename))
+        sources.append((filename, stat.st_mtime, stat.st_size))
+    return sources
+
+def _load_cached(name):
+    try:
+        f = open(data.cachepath(name + '.level'), 'rb')
+    except (IOError, OSError):
+        return None
+    try:
+        try:
+            version, sources, level = pickle.load(f)
+        except Exception:
+            return None
+    finally:
+        f.close()
+
+    if version != CACHE_VERSION:
+        return None
+    filenames = [source[0] for source in sources[1:]]
+    try:
+        if _get_sources(name, filenames) != sources:
+            return None
+    except OSError:
+        return None
+    return level
+
+def _save_cached(name, level):
+    sources = _get_sources(name, level.get_filenames())
+    try:
+        f = open(data.cachepath(name + '.level'), 'wb')
+    except (IOError, OSError):
+        return # A read-only install just goes without the cache
+    try:
+        pickle.dump((CACHE_VERSION, sources, level), f,
+                    pickle.HIGHEST_PROTOCOL)
+    finally:
+        f.close()
+
+_levels = {}
+def load(name=FIRST_LEVEL, headless=False):
+    '''Return the compiled level "name".
+
+    Headless levels only have their geom dimensions worked out, which needs
+    nothing more than the PNG headers, so they are never cached on disk.
+    '''
+    key = (name, headless)
+    if key in _levels:
+        return _levels[key]
+
+    if headless:
+        level = parse(name)
+    else:
+        level = _load_cached(name)
+        if level is None:
+            level = parse(name)
+            level.decode()
+            _save_cached(name, level)
+
+    _levels[key] = level
+    return level
@@ -8,6 +8,7 @@ sys.path.append(current_dir)
 
 import pyglet
 import data
+import prefetch
 
 class Menu(object):
     def __init__(self):
@@ -75,7 +76,19 @@ class MainMenu(Menu):
         self.add_item(MenuItem("Exit", (window.width / 2, 100),
                                pyglet.app.exit))
 
-        self.background = pyglet.image.load(data.filepath('main_menu.png'))
+        self.background = data.load_image('main_menu.png')
+
+        # Shown if Play is pressed before the level has finished loading
+        self.loading = False
+        self.loading_label = pyglet.text.Label("", font_size=14,
+                                               anchor_x="center",
+                                               anchor_y="center",
+                                               x=window.width / 2, y=50)
+
+    def on_key_press(self, symbol, modifiers):
+        if self.loading:
+            return True
+        return super(MainMenu, self).on_key_press(symbol, modifiers)
 
     def on_draw(self):
         window.clear()
@@ -83,8 +96,22 @@ class MainMenu(Menu):
         self.title_shadow.draw()
         self.title.draw()
         super(MainMenu, self).on_draw()
+        if self.loading:
+            text = "Loading... %d%%" % (prefetcher.get_progress() * 100)
+            if text != self.loading_label.text:
+                self.loading_label.text = text
+            self.loading_label.draw()
 
 def run_game():
+    # Usually done by now; if not, the menu keeps drawing, with the progress,
+    # until it is
+    main_menu.loading = True
+    prefetcher.finish(start_game)
+
+def start_game():
+    # The prefetched textures were uploaded in this window's context. They
+    # survive it being closed because pyglet's hidden shadow window shares
+    # GL objects with every window, the game's included.
     window.close()
     import game
     game.main()
@@ -92,9 +119,7 @@ def run_game():
 def show_instructions():
     class Instructions(object):
         def __init__(self):
-            f = open(data.filepath('instructions.htm'), 'r')
-            self.label = pyglet.text.HTMLLabel(f.read(), width=window.width, anchor_y="center", y=window.height / 2, multiline=True)
-            f.close()
+            self.label = pyglet.text.HTMLLabel(data.load_text('instructions.htm'), width=window.width, anchor_y="center", y=window.height / 2, multiline=True)
 
         def on_draw(self):
             window.clear()
@@ -116,6 +141,10 @@ window = pyglet.window.Window(800, 600)
 main_menu = MainMenu()
 window.push_handlers(main_menu)
 
+# Load the first level in the background while the menu is showing
+prefetcher = prefetch.Prefetcher()
+prefetcher.start()
+
 def main():
     pyglet.app.run()
 
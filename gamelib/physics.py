@@ -1,23 +1,53 @@
 import math
 import ode
 import pyglet
+import contacts
 import data
 
 DEFAULT_DENSITY = 0.0001
+HEADLESS = False # Skip images and sprites, for running without a window
+
+# Bodies moving slower than this for AUTO_DISABLE_STEPS steps fall asleep;
+# set on the world, see simulation.Simulation
+AUTO_DISABLE_LINEAR = 2.0
+AUTO_DISABLE_ANGULAR = 0.05
+AUTO_DISABLE_STEPS = 80
+
+STATE_SIZE = 13 # Numbers in a body state, see PhysicsObject.packState()
 
 class StaticObject(object):
-    def __init__(self, space, filename, batch=None):
+    usage = 'static' # Vertex buffer usage; static sprites are placed once
+
+    def __init__(self, space, filename, batch=None,
+                 image=None, size=None, group=None):
         self.space = space
         self.batch = batch
         self.filename = filename
 
-        self.image = pyglet.image.load(data.filepath(filename))
-        self.image.anchor_x = self.image.width / 2
-        self.image.anchor_y = self.image.height / 2
-
-        self.sprite = pyglet.sprite.Sprite(self.image, batch=self.batch)
+        # "image" and "size" can be passed in to skip decoding the file
+        if HEADLESS:
+            self.image = None
+            self.sprite = None
+            if size is None:
+                size = data.image_size(filename)
+            self.width, self.height = size
+        else:
+            if image is None:
+                image = data.load_image(filename)
+
+            # Images are shared, so the anchor goes on a region of our own;
+            # the texture itself is still uploaded only once
+            self.image = image.get_texture().get_region(0, 0, image.width,
+                                                        image.height)
+            self.image.anchor_x = self.image.width / 2
+            self.image.anchor_y = self.image.height / 2
+            self.width, self.height = self.image.width, self.image.height
+
+            self.sprite = pyglet.sprite.Sprite(self.image, batch=self.batch,
+                                               group=group, usage=self.usage)
 
         self.geom = None
+        self.material = contacts.DEFAULT_MATERIAL
 
     def getImage(self):
         return self.image
@@ -28,9 +58,39 @@ class StaticObject(object):
     def getSprite(self):
         return self.sprite
 
+    def getMaterial(self):
+        return self.material
+
+    def setMaterial(self, material):
+        '''Set the contacts.Material of the surface; takes effect once the
+        object is added to the contact handler.
+        '''
+        self.material = material
+
     def getPosition(self):
         return self.geom.getPosition()
 
+    def getInterpolatedPosition(self, alpha):
+        return self.getPosition()
+
+    def getAngle(self):
+        '''Return the rotation around the z axis, in radians.'''
+        matrix = self.geom.getRotation()
+        return math.atan2(matrix[3], matrix[4])
+
+    def getInterpolatedAngle(self, alpha):
+        return self.getAngle()
+
+    def getBounds(self):
+        '''Return the (left, bottom, right, top) of the rotated object.'''
+        x, y = self.getPosition()[0:2]
+        matrix = self.geom.getRotation()
+        sin, cos = abs(matrix[3]), abs(matrix[4])
+        half_width = (self.width * cos + self.height * sin) / 2.0
+        half_height = (self.width * sin + self.height * cos) / 2.0
+        return (x - half_width, y - half_height,
+                x + half_width, y + half_height)
+
     def setPosition(self, position):
         self.geom.setPosition(position)
         #self.geom.setPosition((position[0] + self.image.width / 2, position[1] + self.image.height / 2, 0))
@@ -45,32 +105,52 @@ class StaticObject(object):
     def remove(self):
         self.space.remove(self.geom)
 
-    def update(self):
-        matrix = self.geom.getRotation()
-        rotation = math.atan2(matrix[4], matrix[3]) * 180/math.pi - 90
-        self.sprite.rotation = rotation
+    def delete(self):
+        '''Remove the geom and free the sprite's vertex list.'''
+        self.remove()
+        if self.sprite is not None:
+            self.sprite.delete()
+            self.sprite = None
+
+    def update(self, alpha=1.0):
+        if self.sprite is None:
+            return
+        self.sprite.rotation = -self.getInterpolatedAngle(alpha) * 180/math.pi
 
 class StaticBox(StaticObject):
-    def __init__(self, space, filename, batch=None):
-        super(StaticBox, self).__init__(space, filename, batch)
-        self.geom = ode.GeomBox(self.space, (self.image.width, self.image.height, 1.0))
+    def __init__(self, space, filename, batch=None,
+                 image=None, size=None, group=None):
+        super(StaticBox, self).__init__(space, filename, batch, image, size,
+                                        group)
+        self.geom = ode.GeomBox(self.space, (self.width, self.height, 1.0))
 
 class StaticCylinder(StaticObject):
-    def __init__(self, space, filename, batch=None):
-        super(StaticCylinder, self).__init__(space, filename, batch)
-        self.geom = ode.GeomCylinder(self.space, self.image.width / 2)
+    def __init__(self, space, filename, batch=None,
+                 image=None, size=None, group=None):
+        super(StaticCylinder, self).__init__(space, filename, batch,
+                                             image, size, group)
+        self.geom = ode.GeomCylinder(self.space, self.width / 2)
 
 class PhysicsObject(StaticObject):
-    def __init__(self, world, space, filename, batch=None):
-        super(PhysicsObject, self).__init__(space, filename, batch)
+    usage = 'dynamic'
+
+    def __init__(self, world, space, filename, batch=None,
+                 image=None, size=None, group=None):
+        super(PhysicsObject, self).__init__(space, filename, batch,
+                                            image, size, group)
         self.world = world
 
         self.body = ode.Body(self.world)
         self.mass = None
+        self.previous_position = None
+        self.previous_angle = None
+        self.sprite_asleep = False # Rotation set since falling asleep
+        self.placed_asleep = False # Vertices placed since, see SpriteSync
 
         self.joint2d = ode.Plane2DJoint(world)
         self.joint2d.attach(self.body, ode.environment)
 
+        self.constrain()
         self.update()
 
     def getBody(self):
@@ -85,40 +165,118 @@ class PhysicsObject(StaticObject):
     def setPosition(self, position):
         return self.body.setPosition(position)
 
+    def isSleeping(self):
+        return not self.body.isEnabled()
+
+    def delete(self):
+        super(PhysicsObject, self).delete()
+        self.body.disable()
+
+    def packState(self, values):
+        '''Append the body's position, quaternion, linear and angular
+        velocity (STATE_SIZE numbers) to the array "values".
+        '''
+        body = self.body
+        values.extend(body.getPosition())
+        values.extend(body.getQuaternion())
+        values.extend(body.getLinearVel())
+        values.extend(body.getAngularVel())
+
+    def unpackState(self, values, offset, enabled=True):
+        '''Put the body back in a state saved by packState().'''
+        body = self.body
+        body.setPosition(values[offset:offset + 3])
+        body.setQuaternion(values[offset + 3:offset + 7])
+        body.setLinearVel(values[offset + 7:offset + 10])
+        body.setAngularVel(values[offset + 10:offset + 13])
+        if enabled:
+            body.enable()
+        else:
+            body.disable()
+        self.previous_position = None
+        self.previous_angle = None
+        self.sprite_asleep = False
+        self.placed_asleep = False
+
+    def saveState(self):
+        # Sleeping bodies too, so one waking up blends from where it slept
+        self.previous_position = self.body.getPosition()
+        self.previous_angle = self.getAngle()
+
+    def getInterpolatedPosition(self, alpha):
+        '''Blend between the saved and the current position.'''
+        position = self.body.getPosition()
+        if self.previous_position is None:
+            return position
+        x, y, z = self.previous_position
+        return (x + (position[0] - x) * alpha,
+                y + (position[1] - y) * alpha,
+                z + (position[2] - z) * alpha)
+
+    def getAngle(self):
+        matrix = self.body.getRotation()
+        return math.atan2(matrix[3], matrix[4])
+
+    def getInterpolatedAngle(self, alpha):
+        '''Blend between the saved and the current angle, the short way
+        round.
+        '''
+        angle = self.getAngle()
+        if self.previous_angle is None:
+            return angle
+        turn = (angle - self.previous_angle + math.pi) % (2 * math.pi) - \
+            math.pi
+        return self.previous_angle + turn * alpha
+
     def setRotation(self, degrees):
         matrix = self.body.getRotation()
-        matrix[0] = matrix[4] = math.cos(degrees)
-        matrix[3] = math.sin(degrees)
+        matrix[0] = matrix[4] = math.cos(degrees*math.pi/180)
+        matrix[3] = math.sin(degrees*math.pi/180)
         matrix[1] = -matrix[3]
         self.body.setRotation(matrix)
 
-    def update(self):
+    def constrain(self):
+        '''Remove any rotation out of the 2D plane.'''
+        if not self.body.isEnabled():
+            return
         quaternion = list(self.body.getQuaternion())
         quaternion[1] = quaternion[2] = 0
         self.body.setQuaternion(quaternion)
 
-        matrix = self.body.getRotation()
-        rotation = math.atan2(matrix[4], matrix[3]) * 180/math.pi - 90
-        self.sprite.rotation = rotation
+    def update(self, alpha=1.0):
+        if self.sprite is None:
+            return
+
+        # A sleeping body can't have turned since the last sync
+        asleep = not self.body.isEnabled()
+        if asleep and self.sprite_asleep:
+            return
+        self.sprite_asleep = asleep
+
+        self.sprite.rotation = -self.getInterpolatedAngle(alpha) * 180/math.pi
 
 class PhysicsBox(PhysicsObject):
-    def __init__(self, world, space, filename, batch=None):
-        super(PhysicsBox, self).__init__(world, space, filename, batch)
+    def __init__(self, world, space, filename, batch=None,
+                 image=None, size=None, group=None):
+        super(PhysicsBox, self).__init__(world, space, filename, batch,
+                                         image, size, group)
 
         self.mass = ode.Mass()
-        self.mass.setBox(DEFAULT_DENSITY, self.image.width / 2, self.image.height / 2, 1)
+        self.mass.setBox(DEFAULT_DENSITY, self.width / 2, self.height / 2, 1)
         self.body.setMass(self.mass)
 
-        self.geom = ode.GeomBox(self.space, (self.image.width, self.image.height, 1.0))
+        self.geom = ode.GeomBox(self.space, (self.width, self.height, 1.0))
         self.geom.setBody(self.body)
 
 class PhysicsCylinder(PhysicsObject):
-    def __init__(self, world, space, filename, batch=None):
-        super(PhysicsCylinder, self).__init__(world, space, filename, batch)
+    def __init__(self, world, space, filename, batch=None,
+                 image=None, size=None, group=None):
+        super(PhysicsCylinder, self).__init__(world, space, filename, batch,
+                                              image, size, group)
 
         self.mass = ode.Mass()
-        self.mass.setCylinder(DEFAULT_DENSITY, 3, self.image.width / 2, 1.0)
+        self.mass.setCylinder(DEFAULT_DENSITY, 3, self.width / 2, 1.0)
         self.body.setMass(self.mass)
 
-        self.geom = ode.GeomCylinder(self.space, self.image.width / 2)
+        self.geom = ode.GeomCylinder(self.space, self.width / 2)
         self.geom.setBody(self.body)
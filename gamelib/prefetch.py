@@ -0,0 +1,137 @@
+'''Loading a level's assets while the main menu is up.
+
+get_manifest() lists the files playing a level needs. A Prefetcher decodes
+them on a pool of threads, through data.load_image() so they land in its
+caches, and cuts the background into tiles if that hasn't been done yet;
+most of that time is spent in the image decoder, zlib and file reads, which
+let go of the interpreter lock. The level is then compiled from the decoded
+images.
+
+Textures can only be created on the thread drawing the window, so update(),
+scheduled on the clock, uploads the level's images a few at a time between
+menu frames. The textures are created in the menu window's context, but
+pyglet's hidden shadow window shares GL objects with every window, so they
+are still there in the game's window after the menu's is closed.
+
+By the time Play is pressed, loading the level is a dictionary lookup and
+its sprites' textures already exist. If it's pressed sooner, finish() lets
+the menu keep drawing, and showing get_progress(), until then.
+'''
+
+import Queue
+import threading
+import time
+
+import pyglet
+
+import data
+import level
+import tiles
+
+PREFETCH_THREADS = 4
+UPLOAD_TIME_BUDGET = 0.005 # Most seconds spent uploading textures per frame
+
+def get_manifest(name=level.FIRST_LEVEL):
+    '''Return the images and the background of the level "name".'''
+    filenames = level.parse(name).get_filenames()
+    return filenames[1:], filenames[0]
+
+class Prefetcher(object):
+    def __init__(self, name=level.FIRST_LEVEL, threads=PREFETCH_THREADS):
+        self.name = name
+        self.threads = threads
+        self.jobs = Queue.Queue()
+        self.thread = None
+        self.level = None # Set once compiled, by the prefetching thread
+        self.uploads = None # Filenames still to upload, once compiled
+        self.done = False
+        self.callback = None # Called once done, see finish()
+
+        # Jobs and uploads, for get_progress()
+        self.lock = threading.Lock()
+        self.total = 0
+        self.finished = 0
+
+    def start(self):
+        '''Start prefetching, and uploading as images become ready.'''
+        images, background = get_manifest(self.name)
+        for filename in images:
+            self.jobs.put((data.load_image, filename))
+        if not tiles.has_tiles(background):
+            self.jobs.put((tiles.cut_tiles, background))
+        self.total = self.jobs.qsize() + len(images)
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        pyglet.clock.schedule(self.update)
+
+    def run(self):
+        workers = [threading.Thread(target=self.work)
+                   for index in xrange(self.threads)]
+        for worker in workers:
+            worker.setDaemon(True)
+            worker.start()
+        for worker in workers:
+            worker.join()
+        data.save_hashes()
+
+        # Every image is in data's caches by now, so this decodes nothing
+        try:
+            self.level = level.load(self.name)
+        except Exception:
+            pass # The game loads it again, and reports what went wrong
+
+    def work(self):
+        while True:
+            try:
+                function, filename = self.jobs.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                function(filename)
+            except Exception:
+                pass # The game loads it again, and reports what went wrong
+            self.add_finished()
+
+    def add_finished(self, count=1):
+        self.lock.acquire()
+        try:
+            self.finished += count
+        finally:
+            self.lock.release()
+
+    def get_progress(self):
+        '''Return how much has been done, from 0 to 1.'''
+        if self.done or not self.total:
+            return 1.0
+        return min(float(self.finished) / self.total, 1.0)
+
+    def update(self, dt):
+        '''Upload the compiled level's images for UPLOAD_TIME_BUDGET.'''
+        if self.uploads is None:
+            if self.thread.isAlive():
+                return
+            if self.level is None:
+                self.uploads = [] # Failed; nothing to upload
+            else:
+                self.uploads = self.level.get_filenames()[1:]
+
+        end = time.time() + UPLOAD_TIME_BUDGET
+        while self.uploads and time.time() < end:
+            self.level.get_image(self.uploads.pop()).get_texture()
+            self.add_finished()
+        if not self.uploads:
+            pyglet.clock.unschedule(self.update)
+            self.done = True
+            if self.callback is not None:
+                self.callback()
+
+    def finish(self, callback):
+        '''Call "callback" once everything is loaded, straight away if it
+        already is. Loading carries on between frames meanwhile.
+        '''
+        if self.done or self.thread is None:
+            callback()
+        else:
+            self.callback = callback
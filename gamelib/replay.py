@@ -0,0 +1,96 @@
+'''Recording and playback of player input.
+
+Input is logged once per physics step, so playing a recording back through a
+fresh Simulation reproduces the original run exactly, at whatever speed the
+machine can manage.
+
+Recordings are stored run-length encoded: a header followed by
+(step count, input flags) runs, so holding a key for a whole level costs a
+handful of bytes.
+'''
+
+import struct
+
+from simulation import PHYSICS_STEP
+
+MAGIC = 'TWRP'
+VERSION = 1
+HEADER = struct.Struct('>4sBdI') # magic, version, physics step, run count
+RUN = struct.Struct('>IB') # steps, input flags
+
+INPUT_LEFT = 1
+INPUT_RIGHT = 2
+
+_direction_flags = {None: 0, 'left': INPUT_LEFT, 'right': INPUT_RIGHT}
+_flag_directions = {0: None, INPUT_LEFT: 'left', INPUT_RIGHT: 'right'}
+
+class Recorder(object):
+    def __init__(self):
+        self.runs = []
+
+    def record(self, direction):
+        '''Log the direction held during one physics step.'''
+        flags = _direction_flags[direction]
+        if self.runs and self.runs[-1][1] == flags:
+            self.runs[-1][0] += 1
+        else:
+            self.runs.append([1, flags])
+
+    def get_steps(self):
+        return sum([steps for steps, flags in self.runs])
+
+    def save(self, filename):
+        f = open(filename, 'wb')
+        try:
+            f.write(HEADER.pack(MAGIC, VERSION, PHYSICS_STEP, len(self.runs)))
+            for steps, flags in self.runs:
+                f.write(RUN.pack(steps, flags))
+        finally:
+            f.close()
+
+class Replay(object):
+    def __init__(self, runs):
+        self.runs = runs
+        self.steps = sum([steps for steps, flags in runs])
+        self.rewind()
+
+    def rewind(self):
+        self.index = 0
+        self.run_start = 0
+
+    def get_duration(self):
+        return self.steps * PHYSICS_STEP
+
+    def direction_at_step(self, step):
+        '''Return the direction held during physics step "step".
+
+        Steps must be asked for in increasing order (until rewind() is
+        called), which keeps the lookup constant time per step.
+        '''
+        runs = self.runs
+        while (self.index < len(runs) and
+               step >= self.run_start + runs[self.index][0]):
+            self.run_start += runs[self.index][0]
+            self.index += 1
+        if self.index >= len(runs):
+            return None
+        return _flag_directions[runs[self.index][1]]
+
+    def direction_at(self, t):
+        return self.direction_at_step(int(t / PHYSICS_STEP + 0.5))
+
+    @classmethod
+    def load(cls, filename):
+        f = open(filename, 'rb')
+        try:
+            magic, version, step, count = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('%s is not a version %d replay' %
+                                 (filename, VERSION))
+            if step != PHYSICS_STEP:
+                raise ValueError('%s was recorded with a physics step of %g, '
+                                 'not %g' % (filename, step, PHYSICS_STEP))
+            runs = [RUN.unpack(f.read(RUN.size)) for i in xrange(count)]
+        finally:
+            f.close()
+        return cls(runs)
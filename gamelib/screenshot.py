@@ -0,0 +1,148 @@
+'''Screenshots that don't stall the game.
+
+Reading the frame back through pyglet's buffer manager and saving it with
+pyglet's image encoders waits for the video card, converts the pixels in
+Python and encodes the PNG in Python, all before the next frame can start.
+
+Screenshots instead reads each frame into one of two pixel buffer objects,
+where supported, and only maps it a frame later, when the copy has finished
+in the background. The pixels are then written out by a worker thread;
+compressing them is done by zlib, which lets go of the interpreter lock, so
+the game keeps running meanwhile. Several frames in a row can be captured
+as numbered files with burst().
+'''
+
+import ctypes
+import Queue
+import struct
+import threading
+import zlib
+
+import pyglet
+
+PNG_COMPRESSION = 6 # zlib level, 1 (fastest) to 9 (smallest)
+
+def write_png(filename, width, height, pixels):
+    '''Write RGB "pixels", bottom row first as GL reads them, to a PNG.'''
+    pitch = width * 3
+    rows = ['\0' + pixels[y * pitch:(y + 1) * pitch]
+            for y in xrange(height - 1, -1, -1)]
+
+    def chunk(kind, body):
+        crc = zlib.crc32(kind + body) & 0xffffffff
+        return struct.pack('>I', len(body)) + kind + body + \
+            struct.pack('>I', crc)
+
+    f = open(filename, 'wb')
+    try:
+        f.write('\x89PNG\r\n\x1a\n')
+        f.write(chunk('IHDR', struct.pack('>IIBBBBB', width, height,
+                                          8, 2, 0, 0, 0)))
+        f.write(chunk('IDAT', zlib.compress(''.join(rows), PNG_COMPRESSION)))
+        f.write(chunk('IEND', ''))
+    finally:
+        f.close()
+
+class Screenshots(object):
+    def __init__(self):
+        self.requests = [] # Filenames of the frames to capture, in order
+        self.pending = None # (filename, width, height, buffer) being read
+        self.queue = Queue.Queue()
+        self.worker = None
+
+        self.buffers = None
+        self.buffer_size = 0
+        self.next_buffer = 0
+
+    def capture(self, filename):
+        '''Save the next frame drawn to "filename".'''
+        self.requests.append(filename)
+
+    def burst(self, count, pattern):
+        '''Save the next "count" frames, numbered through "pattern".'''
+        self.requests.extend([pattern % number
+                              for number in xrange(1, count + 1)])
+
+    def update(self, width, height):
+        '''Call once a frame has been drawn, before flipping the window.'''
+        if self.pending is not None:
+            self.finish()
+        if self.requests:
+            self.read(self.requests.pop(0), width, height)
+
+    def use_buffers(self):
+        gl_info = pyglet.gl.gl_info
+        return (gl_info.have_version(2, 1) or
+                gl_info.have_extension('GL_ARB_pixel_buffer_object'))
+
+    def read(self, filename, width, height):
+        gl = pyglet.gl
+        size = width * height * 3
+        gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 1)
+        if not self.use_buffers():
+            pixels = (gl.GLubyte * size)()
+            gl.glReadPixels(0, 0, width, height, gl.GL_RGB,
+                            gl.GL_UNSIGNED_BYTE, pixels)
+            self.write(filename, width, height, ctypes.string_at(pixels,
+                                                                 size))
+            return
+
+        if self.buffers is None:
+            self.buffers = (gl.GLuint * 2)()
+            gl.glGenBuffers(2, self.buffers)
+        if self.buffer_size != size:
+            for buffer in self.buffers:
+                gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER_ARB, buffer)
+                gl.glBufferData(gl.GL_PIXEL_PACK_BUFFER_ARB, size, None,
+                                gl.GL_STREAM_READ)
+            self.buffer_size = size
+
+        # Returns straight away; the copy is only waited for in finish()
+        buffer = self.buffers[self.next_buffer]
+        self.next_buffer = 1 - self.next_buffer
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER_ARB, buffer)
+        gl.glReadPixels(0, 0, width, height, gl.GL_RGB, gl.GL_UNSIGNED_BYTE,
+                        None)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER_ARB, 0)
+        self.pending = (filename, width, height, buffer)
+
+    def finish(self):
+        '''Collect the pixels of the frame read last.'''
+        gl = pyglet.gl
+        filename, width, height, buffer = self.pending
+        self.pending = None
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER_ARB, buffer)
+        pointer = gl.glMapBuffer(gl.GL_PIXEL_PACK_BUFFER_ARB,
+                                 gl.GL_READ_ONLY)
+        if pointer:
+            pixels = ctypes.string_at(pointer, width * height * 3)
+            gl.glUnmapBuffer(gl.GL_PIXEL_PACK_BUFFER_ARB)
+            self.write(filename, width, height, pixels)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER_ARB, 0)
+
+    def write(self, filename, width, height, pixels):
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.run)
+            self.worker.setDaemon(True)
+            self.worker.start()
+        self.queue.put((filename, width, height, pixels))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            write_png(*item)
+
+    def close(self):
+        '''Finish every screenshot taken and stop the worker thread.'''
+        if self.pending is not None:
+            self.finish()
+        if self.worker is not None:
+            self.queue.put(None)
+            self.worker.join()
+            self.worker = None
+        if self.buffers is not None:
+            pyglet.gl.glDeleteBuffers(2, self.buffers)
+            self.buffers = None
+            self.buffer_size = 0
@@ -0,0 +1,277 @@
+'''Window-independent game simulation.
+
+Owns the ODE world, the player and the objects of a level.Level so the
+physics can be stepped without pyglet ever opening a window.
+'''
+
+import array
+
+import ode
+
+import contacts
+import physics
+
+# Gameplay constants
+GRAVITY = -100.0
+PHYSICS_STEP = 0.0025
+PLAYER_SPEED = 5.0
+PLAYER_SPEED_STEP = 1.0
+PLAYER_SPEED_TIME = 25.0 # The amount of times speed is updated per second
+# Bodies are pulled back into the 2D plane as often as the window version
+# used to, once a frame at 60 frames a second, but on a whole number of steps
+# so runs replay exactly. The Plane2DJoint already keeps them in the plane;
+# this only undoes the rounding error that tilts them out of it, so the tilt
+# never builds up over more than CONSTRAIN_STEPS steps (1/57th of a second).
+CONSTRAIN_RATE = 60.0
+CONSTRAIN_STEPS = int(round(1.0 / (CONSTRAIN_RATE * PHYSICS_STEP))) # 7
+STATIC_TREE_DEPTH = 5 # Levels of the quadtree static props are kept in
+
+# Player
+class Player(physics.PhysicsCylinder):
+    def __init__(self, world, space, filename, start_position, batch=None,
+                 image=None, size=None, group=None):
+        super(Player, self).__init__(world, space, filename, batch, image,
+                                     size, group)
+        self.speed_dt = 0
+
+        self.start_position = start_position
+        self.body.setPosition(self.start_position)
+
+    def reset(self):
+        self.body.setAngularVel((0, 0, 0))
+        self.body.setLinearVel((0, 0, 0))
+        self.body.setPosition(self.start_position)
+        self.body.setQuaternion((1, 0, 0, 0))
+        self.body.enable()
+
+    def move_left(self, dt):
+        self.update_speed(dt, 'left')
+
+    def move_right(self, dt):
+        self.update_speed(dt, 'right')
+
+    def update_speed(self, dt, direction):
+        # Setting a velocity doesn't wake a body that has fallen asleep
+        self.body.enable()
+        zspeed = self.body.getAngularVel()[2]
+        if direction == 'left' and zspeed < PLAYER_SPEED:
+            zspeed = min(PLAYER_SPEED, zspeed + PLAYER_SPEED_STEP *
+                         PLAYER_SPEED_TIME * dt)
+        elif direction == 'right' and zspeed > -PLAYER_SPEED:
+            zspeed = max(-PLAYER_SPEED, zspeed - PLAYER_SPEED_STEP *
+                          PLAYER_SPEED_TIME * dt)
+        self.body.setAngularVel((0, 0, zspeed))
+
+# Level prop types
+PROP_CLASSES = {
+    'box': physics.PhysicsBox,
+    'cylinder': physics.PhysicsCylinder,
+    'static_box': physics.StaticBox,
+    'static_cylinder': physics.StaticCylinder,
+}
+
+class Snapshot(object):
+    '''The state of a simulation's bodies, packed into one array.
+
+    Taking one costs a few calls per body, so it's fine to take one every
+    step. It can only be restored into the level it was taken from. ODE
+    doesn't expose how long a body has been resting, so restored bodies that
+    are awake start counting towards falling asleep again.
+    '''
+    def __init__(self, bodies, steps, input_dt):
+        self.bodies = bodies
+        self.steps = steps
+        self.input_dt = input_dt
+        self.values = array.array('d')
+        self.enabled = array.array('B')
+        for body in bodies:
+            body.packState(self.values)
+            self.enabled.append(not body.isSleeping())
+
+    def restore(self):
+        values, enabled = self.values, self.enabled
+        for index, body in enumerate(self.bodies):
+            body.unpackState(values, index * physics.STATE_SIZE,
+                             enabled[index])
+
+class Simulation(object):
+    def __init__(self, level, batch=None,
+                 contact_handler=contacts.ContactManager, group=None):
+        self.level = level
+        self.batch = batch
+        self.group = group # Sprites are drawn in this group, e.g. a Camera
+
+        # Set up ODE
+        self.world = ode.World()
+        self.world.setGravity((0, GRAVITY, 0))
+        self.world.setERP(0.8)
+
+        # Resting bodies fall asleep until something touches them
+        self.world.setAutoDisableFlag(True)
+        self.world.setAutoDisableLinearThreshold(physics.AUTO_DISABLE_LINEAR)
+        self.world.setAutoDisableAngularThreshold(
+            physics.AUTO_DISABLE_ANGULAR)
+        self.world.setAutoDisableSteps(physics.AUTO_DISABLE_STEPS)
+        self.world.setAutoDisableTime(0)
+        self.contactgroup = ode.JointGroup()
+        self.contacts = contact_handler(self.world, self.contactgroup)
+
+        # Geoms that move live in "space", level props in a quadtree over the
+        # level and the bounds in a space of their own. Both are only ever
+        # collided against "space", never against themselves.
+        self.space = ode.SimpleSpace()
+        self.static_space = None
+        self.static_size = None
+        self.create_static_space(level.size)
+        self.bounds_space = ode.SimpleSpace()
+
+        # Physics limits
+        width, height = level.size
+        self.roof = ode.GeomPlane(self.bounds_space, (0, -1, 0), -height)
+        self.floor = ode.GeomPlane(self.bounds_space, (0, 1, 0), 0)
+        self.wall_left = ode.GeomPlane(self.bounds_space, (1, 0, 0), 0)
+        self.wall_right = ode.GeomPlane(self.bounds_space, (-1, 0, 0), -width)
+
+        player = level.player
+        self.player = Player(self.world, self.space, player.filename,
+                             player.position, batch,
+                             level.get_image(player.filename), player.size,
+                             group)
+        self.level_physics = []
+        self.level_start = None # Snapshot to reset the level to
+        self.bodies = [self.player]
+
+        self.steps = 0
+        self.input_dt = 0.0
+        self.recorder = None
+
+    def step(self, direction=None):
+        '''Advance the world by one PHYSICS_STEP.
+
+        "direction" is the player input held during this step ('left',
+        'right' or None). It is applied PLAYER_SPEED_TIME times per second of
+        simulated time, the same rate the window version uses.
+
+        Everything here depends only on the step count and the input, never
+        on wall-clock time, so a recorded run replays exactly.
+        '''
+        if self.recorder is not None:
+            self.recorder.record(direction)
+
+        if self.steps % CONSTRAIN_STEPS == 0:
+            for body in self.bodies:
+                body.constrain()
+
+        self.input_dt += PHYSICS_STEP
+        if self.input_dt >= 1.0 / PLAYER_SPEED_TIME:
+            if direction:
+                self.player.update_speed(self.input_dt, direction)
+            self.input_dt = 0.0
+
+        near_callback = self.contacts.near_callback
+        self.space.collide(None, near_callback)
+        ode.collide2(self.space, self.bounds_space, None, near_callback)
+
+        # Passed one geom at a time, the quadtree only tests the props in the
+        # blocks the geom overlaps
+        static_space = self.static_space
+        for geom in self.space:
+            ode.collide2(geom, static_space, None, near_callback)
+        self.world.step(PHYSICS_STEP)
+        self.contactgroup.empty()
+        self.steps += 1
+
+    def has_won(self):
+        return self.player.getPosition()[0] > self.level.end
+
+    def load_level(self, level):
+        '''Switch to "level" and start it from the beginning.'''
+        width, height = level.size
+        self.roof.setParams((0, -1, 0), -height)
+        self.wall_right.setParams((-1, 0, 0), -width)
+        self.player.start_position = level.player.position
+        self.level = level
+        self.level_start = None
+        self.reset()
+
+    def reset(self):
+        '''Put the level and the player back to how they started.
+
+        The level's objects are only built the first time. After that just
+        the dynamic bodies are put back in place, keeping their geoms and
+        sprites, so a restart costs nothing for static props.
+        '''
+        if self.level_start is None:
+            self.create_level()
+            self.player.reset()
+            self.steps = 0
+            self.input_dt = 0.0
+            self.level_start = self.take_snapshot()
+        else:
+            self.restore_snapshot(self.level_start)
+        self.save_state()
+
+    def take_snapshot(self):
+        return Snapshot(self.bodies, self.steps, self.input_dt)
+
+    def restore_snapshot(self, snapshot):
+        '''Roll every body, and the step count, back to "snapshot".'''
+        if snapshot.bodies is not self.bodies:
+            raise ValueError('Snapshot was taken in a different level')
+        snapshot.restore()
+        self.steps = snapshot.steps
+        self.input_dt = snapshot.input_dt
+
+    def save_state(self):
+        '''Remember where the bodies are, to interpolate from next step.'''
+        for body in self.bodies:
+            body.saveState()
+
+    def create_static_space(self, size):
+        '''Make a new, empty quadtree for static props covering "size".'''
+        width, height = size
+        # Extents are half sizes, like the centre measured from a corner
+        self.static_space = ode.QuadTreeSpace((width / 2.0, height / 2.0, 0),
+                                              (width / 2.0, height / 2.0, 1),
+                                              STATIC_TREE_DEPTH)
+        self.static_size = tuple(size)
+
+    def create_level(self):
+        for physics_object in self.level_physics:
+            physics_object.delete()
+        self.contacts.clear()
+        if tuple(self.level.size) != self.static_size:
+            self.create_static_space(self.level.size)
+
+        level, batch, group = self.level, self.batch, self.group
+        materials = dict([(name, contacts.Material(name, mu, bounce))
+                          for name, (mu, bounce) in level.materials.items()])
+        self.contacts.set_materials(materials.values())
+
+        self.level_physics = level_physics = []
+        for prop in level.props:
+            cls = PROP_CLASSES[prop.kind]
+            image = level.get_image(prop.filename)
+            if prop.is_static():
+                physics_object = cls(self.static_space, prop.filename, batch,
+                                     image, prop.size, group)
+            else:
+                physics_object = cls(self.world, self.space, prop.filename,
+                                     batch, image, prop.size, group)
+            physics_object.setPosition(prop.position)
+            if prop.rotation:
+                physics_object.setRotation(prop.rotation)
+            physics_object.setMaterial(materials[prop.material])
+            self.contacts.add_object(physics_object)
+            level_physics.append(physics_object)
+
+        self.player.setMaterial(materials[level.player.material])
+        self.contacts.add_object(self.player)
+        for bound in (self.roof, self.floor, self.wall_left, self.wall_right):
+            self.contacts.add_geom(bound, materials['default'])
+
+        self.bodies = [self.player] + [physics_object
+                                       for physics_object in level_physics
+                                       if isinstance(physics_object,
+                                                     physics.PhysicsObject)]
+        return level_physics
@@ -0,0 +1,44 @@
+'''Spatial index for level objects.
+
+A uniform grid of buckets: each item is filed under every cell its bounds
+touch, so finding what overlaps a rectangle only looks at the cells that
+rectangle covers, however long the level is.
+'''
+
+CELL_SIZE = 256
+
+class SpatialIndex(object):
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.bounds = {}
+
+    def get_cells(self, x0, y0, x1, y1):
+        size = self.cell_size
+        for cx in xrange(int(x0 // size), int(x1 // size) + 1):
+            for cy in xrange(int(y0 // size), int(y1 // size) + 1):
+                yield cx, cy
+
+    def insert(self, item, bounds):
+        '''File "item" under its (left, bottom, right, top) bounds.'''
+        self.bounds[item] = bounds
+        for cell in self.get_cells(*bounds):
+            self.cells.setdefault(cell, []).append(item)
+
+    def remove(self, item):
+        for cell in self.get_cells(*self.bounds.pop(item)):
+            self.cells[cell].remove(item)
+
+    def query(self, x0, y0, x1, y1):
+        '''Return the set of items whose bounds overlap the rectangle.'''
+        found = set()
+        cells = self.cells
+        bounds = self.bounds
+        for cell in self.get_cells(x0, y0, x1, y1):
+            for item in cells.get(cell, ()):
+                if item in found:
+                    continue
+                left, bottom, right, top = bounds[item]
+                if left <= x1 and right >= x0 and bottom <= y1 and top >= y0:
+                    found.add(item)
+        return found
@@ -0,0 +1,210 @@
+'''Batched sprite placement for physics objects.
+
+Sprites are placed in world coordinates; scrolling is left to a
+camera.Camera group, so static objects are placed once, through the Sprite
+API, when the objects are set and are never written again.
+
+Placing the dynamic sprites one at a time through Sprite.rotation and
+Sprite.position recomputes each quad in Python, twice. SpriteSync instead
+gathers the transform of every moving body into one NumPy array, works out
+all the quad corners at once and writes them straight into the batch's
+vertex buffers.
+
+Given the camera's view, only the sprites near it are shown: static objects
+are looked up in a SpatialIndex and dynamic ones checked against their
+bounds. Sprites that leave the view are moved out of the batch into one that
+is never drawn, and only the shown dynamic sprites are placed, so sprites
+off screen cost nothing to draw, place or upload until they come back.
+
+Bodies that were already asleep when their sprite was last placed haven't
+moved since, so they are left out until they wake up.
+
+Synced dynamic sprites' x, y and rotation attributes are not kept up to
+date. Without NumPy, SpriteSync falls back to placing them one at a time.
+'''
+
+import math
+
+import pyglet
+
+try:
+    import numpy
+    import numpy.ctypeslib
+except ImportError:
+    numpy = None
+
+import physics
+import spatial
+
+CULL_MARGIN = 64 # Pixels around the view that still count as visible
+
+class SpriteSync(object):
+    def __init__(self, objects=()):
+        self.objects = None
+        self.set_objects(objects)
+
+    def set_objects(self, objects):
+        '''Sync "objects" from now on; does nothing if it's the same list.'''
+        if objects is self.objects:
+            return
+        self.objects = objects
+        self.regions = None
+        self.batch = None # The batch shown sprites are drawn in
+        self.hidden_batch = pyglet.graphics.Batch() # Never drawn
+
+        self.static = []
+        self.dynamic = []
+        for physics_object in objects:
+            if physics_object.getSprite() is None:
+                continue
+            if isinstance(physics_object, physics.PhysicsObject):
+                self.dynamic.append(physics_object)
+            else:
+                self.static.append(physics_object)
+            if self.batch is None:
+                self.batch = physics_object.getSprite().batch
+        self.shown = set(self.static + self.dynamic)
+        self.shown_dynamic = self.dynamic
+        self.moving = None # The shown dynamic sprites still to be placed
+
+        self.index = spatial.SpatialIndex()
+        for physics_object in self.static:
+            physics_object.update()
+            physics_object.getSprite().position = \
+                physics_object.getPosition()[0:2]
+            self.index.insert(physics_object, physics_object.getBounds())
+
+    def get_visible(self, view):
+        '''Return the set of objects within CULL_MARGIN of "view", a
+        (left, bottom, right, top) rectangle in world coordinates.
+        '''
+        left, bottom, right, top = view
+        left, bottom = left - CULL_MARGIN, bottom - CULL_MARGIN
+        right, top = right + CULL_MARGIN, top + CULL_MARGIN
+        visible = self.index.query(left, bottom, right, top)
+        for physics_object in self.dynamic:
+            x0, y0, x1, y1 = physics_object.getBounds()
+            if x0 <= right and x1 >= left and y0 <= top and y1 >= bottom:
+                visible.add(physics_object)
+        return visible
+
+    def show(self, visible):
+        '''Move the sprites that left "visible" out of the batch, and those
+        that entered back in.
+        '''
+        if self.batch is None:
+            return # Sprites drawn on their own can't be culled this way
+        hidden = self.shown - visible
+        entered = visible - self.shown
+        if not hidden and not entered:
+            return
+        for physics_object in hidden:
+            physics_object.getSprite().batch = self.hidden_batch
+        for physics_object in entered:
+            physics_object.getSprite().batch = self.batch
+        self.shown = visible
+        self.shown_dynamic = [physics_object
+                              for physics_object in self.dynamic
+                              if physics_object in visible]
+        self.regions = None # The vertex lists have moved
+
+    def sync(self, alpha=1.0, view=None):
+        '''Place the dynamic sprites at their objects' positions.
+
+        "alpha" is passed on to getInterpolatedPosition() and
+        getInterpolatedAngle(). If "view" is
+        given, sprites outside it are culled instead of placed.
+        '''
+        if view is None:
+            self.show(set(self.static + self.dynamic))
+        else:
+            self.show(self.get_visible(view))
+        if numpy is None:
+            self.sync_sprites(alpha)
+            return
+
+        # Only remapped when a body falls asleep or wakes up
+        moving = [physics_object for physics_object in self.shown_dynamic
+                  if not (physics_object.placed_asleep and
+                          physics_object.isSleeping())]
+        if moving != self.moving:
+            self.moving = moving
+            self.regions = None
+        if not moving:
+            return
+        if self.regions is None or self.is_stale():
+            self.map_buffers()
+
+        # Gather the transforms: x, y, sin and cos of the rotation
+        values = []
+        for physics_object in moving:
+            physics_object.placed_asleep = physics_object.isSleeping()
+            x, y = physics_object.getInterpolatedPosition(alpha)[0:2]
+            angle = physics_object.getInterpolatedAngle(alpha)
+            values.extend((x, y, math.sin(angle), math.cos(angle)))
+        transforms = numpy.array(values).reshape((-1, 4, 1))
+
+        corners = self.corners
+        local = self.local
+        local_x, local_y = local[..., 0], local[..., 1]
+        x, y = transforms[:, 0], transforms[:, 1]
+        sin, cos = transforms[:, 2], transforms[:, 3]
+        corners[..., 0] = local_x * cos - local_y * sin + x
+        corners[..., 1] = local_x * sin + local_y * cos + y
+
+        vertices = corners.astype(numpy.int32).reshape((-1, 8))
+        for region, array, indices, elements in self.regions:
+            array[elements] = vertices[indices]
+            region.invalidate()
+
+    def sync_sprites(self, alpha=1.0):
+        '''Place the shown dynamic sprites one at a time, through the Sprite
+        API.
+        '''
+        for physics_object in self.shown_dynamic:
+            physics_object.update(alpha)
+            x, y = physics_object.getInterpolatedPosition(alpha)[0:2]
+            physics_object.getSprite().position = (x, y)
+
+    def is_stale(self):
+        for domain, version in self.versions:
+            if domain._version != version:
+                return True
+        return False
+
+    def map_buffers(self):
+        '''Map the moving sprites' vertices in the batch's buffers to NumPy
+        arrays.
+
+        Culled sprites are in another batch, so each domain's mapped span
+        only covers the sprites on screen, and only that is uploaded.
+        '''
+        # Corners of each quad around its anchor, before rotation
+        self.local = numpy.empty((len(self.moving), 4, 2))
+        for index, physics_object in enumerate(self.moving):
+            texture = physics_object.getSprite().image
+            x1, y1 = -texture.anchor_x, -texture.anchor_y
+            x2, y2 = x1 + texture.width, y1 + texture.height
+            self.local[index] = ((x1, y1), (x2, y1), (x2, y2), (x1, y2))
+        self.corners = numpy.empty(self.local.shape)
+
+        # Group the vertex lists by domain, mapping each domain's span once
+        domains = {}
+        for index, physics_object in enumerate(self.moving):
+            vertex_list = physics_object.getSprite()._vertex_list
+            domains.setdefault(vertex_list.domain, []).append(
+                (vertex_list.start, index))
+
+        self.regions = []
+        self.versions = []
+        for domain, lists in domains.items():
+            first = min([start for start, index in lists])
+            end = max([start for start, index in lists]) + 4
+            attribute = domain.attribute_names['vertices']
+            region = attribute.get_region(attribute.buffer, first, end - first)
+            array = numpy.ctypeslib.as_array(region.array)
+            indices = numpy.array([index for start, index in lists])
+            elements = numpy.array([numpy.arange(8) + (start - first) * 2
+                                    for start, index in lists])
+            self.regions.append((region, array, indices, elements))
+            self.versions.append((domain, domain._version))
@@ -0,0 +1,143 @@
+'''Parameter sweeps for level tuning.
+
+Plays a level headless once for every combination of the values given for
+gravity, player speed, bounce and density, with the same scripted input,
+and reports whether and how fast each one finishes the level. Every run
+builds its own ODE world, so the runs are spread over a pool of processes,
+one per core by default.
+
+Values are given as comma separated lists, for example:
+
+  python run_sweep.py --gravity=-80,-100,-120 --bounce=0.3,0.5
+'''
+
+import copy
+import itertools
+import multiprocessing
+import optparse
+import time
+
+import contacts
+import headless
+import level
+import physics
+import simulation
+from simulation import PHYSICS_STEP
+
+PARAMETERS = ('gravity', 'speed', 'bounce', 'density')
+
+def apply_config(config):
+    '''Set the module constants for "config" in this process.'''
+    simulation.GRAVITY = config['gravity']
+    simulation.PLAYER_SPEED = config['speed']
+    physics.DEFAULT_DENSITY = config['density']
+
+def run_config(args):
+    '''Play one configuration; returns (config, winning time or None,
+    elapsed seconds).
+    '''
+    config, name, timeline, duration = args
+    apply_config(config)
+
+    # Levels are shared, so the bounce goes into a copy's materials; the
+    # 'default' one is also the level bounds'
+    physics.HEADLESS = True
+    tuned = copy.copy(level.load(name, headless=True))
+    tuned.materials = dict([(material, (mu, config['bounce']))
+                            for material, (mu, bounce)
+                            in tuned.materials.items()])
+    sim = simulation.Simulation(tuned)
+    sim.reset()
+    bounce = sim.contacts.get_parameters(sim.floor, sim.player.getGeom())[2]
+    assert bounce == config['bounce'], \
+        'Swept bounce %g not applied, the floor has %g' % (config['bounce'],
+                                                           bounce)
+    if duration is None:
+        duration = tuned.time
+
+    timeline.rewind()
+    steps = int(duration / PHYSICS_STEP + 0.5)
+    won = None
+    start = time.time()
+    for step in xrange(steps):
+        sim.step(timeline.direction_at(sim.steps * PHYSICS_STEP))
+        if sim.has_won():
+            won = sim.steps * PHYSICS_STEP
+            break
+    return config, won, time.time() - start
+
+def get_configs(values):
+    '''Return a config for every combination of "values", which maps each
+    of PARAMETERS to a list.
+    '''
+    return [dict(zip(PARAMETERS, combination)) for combination in
+            itertools.product(*[values[parameter]
+                                for parameter in PARAMETERS])]
+
+def sweep(configs, name=level.FIRST_LEVEL, timeline=None, duration=None,
+          processes=None):
+    '''Play every config across a process pool; returns the results of
+    run_config() in the order of "configs", and the elapsed seconds.
+    '''
+    if timeline is None:
+        timeline = headless.Timeline()
+    pool = multiprocessing.Pool(processes)
+    start = time.time()
+    try:
+        results = pool.map(run_config, [(config, name, timeline, duration)
+                                        for config in configs], 1)
+    finally:
+        pool.close()
+        pool.join()
+    return results, time.time() - start
+
+def parse_values(text):
+    return [float(value) for value in text.split(',')]
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-g', '--gravity', default=str(simulation.GRAVITY),
+                      help='gravity values (default: %default)')
+    parser.add_option('-s', '--speed', default=str(simulation.PLAYER_SPEED),
+                      help='player speed values (default: %default)')
+    parser.add_option('-b', '--bounce', default=str(contacts.CONTACT_BOUNCE),
+                      help='bounce of every material (default: %default)')
+    parser.add_option('--density', default=str(physics.DEFAULT_DENSITY),
+                      help='prop density values (default: %default)')
+    parser.add_option('-d', '--duration', type='float',
+                      help='seconds of game time to allow '
+                           '(default: the level time limit)')
+    parser.add_option('-l', '--level', default=level.FIRST_LEVEL,
+                      help='level to play')
+    parser.add_option('-t', '--timeline',
+                      help='input timeline file (default: hold right)')
+    parser.add_option('-j', '--processes', type='int',
+                      help='processes to run (default: one per core)')
+    options, args = parser.parse_args()
+
+    values = {}
+    for parameter in PARAMETERS:
+        values[parameter] = parse_values(getattr(options, parameter))
+    timeline = None
+    if options.timeline:
+        timeline = headless.Timeline.load(options.timeline)
+
+    configs = get_configs(values)
+    results, elapsed = sweep(configs, options.level, timeline,
+                             options.duration, options.processes)
+
+    print '%8s %6s %6s %9s %8s %8s' % ('gravity', 'speed', 'bounce',
+                                       'density', 'finish', 'run time')
+    for config, won, run_time in results:
+        if won is None:
+            finish = '-'
+        else:
+            finish = '%.2fs' % won
+        print '%8g %6g %6g %9g %8s %7.2fs' % (
+            config['gravity'], config['speed'], config['bounce'],
+            config['density'], finish, run_time)
+    print '%d configurations in %.2f seconds (%.2f per second)' % (
+        len(configs), elapsed, len(configs) / max(elapsed, 1e-9))
+
+if __name__ == '__main__':
+    main()
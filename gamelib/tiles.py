@@ -0,0 +1,164 @@
+'''Tiled, streamed level backgrounds.
+
+A background is cut into TILE_SIZE square tiles the first time it's used and
+the tiles are kept, zlib compressed, in the data cache, or in memory when
+the cache can't be written. Only the tiles near
+the camera are loaded, into a fixed pool of textures that is recycled least
+recently used first, so a background can be larger than the biggest texture
+the video card supports and costs the same to show however large it is.
+'''
+
+import cPickle as pickle
+import os
+import zlib
+
+import pyglet
+
+import data
+
+TILE_SIZE = 256 # A power of two, so tile textures aren't padded
+TILE_POOL_SIZE = 40 # Tile textures kept; an 800x600 view needs about 30
+STREAM_MARGIN = 128 # Pixels around the view whose tiles are loaded early
+CACHE_VERSION = 1
+
+def _get_source(filename):
+    stat = os.stat(data.filepath(filename))
+    return filename, stat.st_mtime, stat.st_size, TILE_SIZE
+
+def _tile_path(filename, column, row):
+    return data.cachepath('%s.%d.%d.tile' % (filename, column, row))
+
+def cut_tiles(filename):
+    '''Decode "filename" and store it in the data cache as tiles.
+
+    Returns None, or if the cache can't be written the compressed tiles, by
+    (column, row), to be kept in memory instead.
+    '''
+    image = pyglet.image.load(data.filepath(filename)).get_image_data()
+    width, height = image.width, image.height
+    pitch = width * 4
+    pixels = image.get_data('RGBA', pitch)
+
+    tiles = {}
+    for row in xrange((height + TILE_SIZE - 1) // TILE_SIZE):
+        bottom = row * TILE_SIZE
+        top = min(bottom + TILE_SIZE, height)
+        for column in xrange((width + TILE_SIZE - 1) // TILE_SIZE):
+            left = column * TILE_SIZE * 4
+            right = min(left + TILE_SIZE * 4, pitch)
+            tile = ''.join([pixels[y * pitch + left:y * pitch + right]
+                            for y in xrange(bottom, top)])
+            tiles[column, row] = zlib.compress(tile, 1)
+
+    try:
+        for (column, row), tile in tiles.items():
+            f = open(_tile_path(filename, column, row), 'wb')
+            try:
+                f.write(tile)
+            finally:
+                f.close()
+
+        f = open(data.cachepath(filename + '.tiles'), 'wb')
+        try:
+            pickle.dump((CACHE_VERSION, _get_source(filename)), f,
+                        pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return tiles # A read-only install keeps the tiles in memory
+    return None
+
+def has_tiles(filename):
+    '''Return whether the cached tiles of "filename" are up to date.'''
+    try:
+        f = open(data.cachepath(filename + '.tiles'), 'rb')
+    except (IOError, OSError):
+        return False
+    try:
+        try:
+            version, source = pickle.load(f)
+        except Exception:
+            return False
+    finally:
+        f.close()
+    return version == CACHE_VERSION and source == _get_source(filename)
+
+class TiledBackground(object):
+    def __init__(self, filename, batch, group=None):
+        self.filename = filename
+        self.batch = batch
+        self.group = group
+        self.width, self.height = data.image_size(filename)
+        self.columns = (self.width + TILE_SIZE - 1) // TILE_SIZE
+        self.rows = (self.height + TILE_SIZE - 1) // TILE_SIZE
+
+        self.memory_tiles = None # Compressed tiles, if not in the cache
+        if not has_tiles(filename):
+            self.memory_tiles = cut_tiles(filename)
+
+        self.tiles = {} # (column, row) -> (texture, sprite)
+        self.used = {} # (column, row) -> frame the tile was last needed
+        self.frame = 0
+        self.loads = 0
+
+    def get_tile_size(self, column, row):
+        return (min(TILE_SIZE, self.width - column * TILE_SIZE),
+                min(TILE_SIZE, self.height - row * TILE_SIZE))
+
+    def get_slot(self):
+        '''Return a (texture, sprite) for a new tile, taking the one of the
+        least recently needed tile if the pool is full.
+        '''
+        if len(self.tiles) >= TILE_POOL_SIZE:
+            oldest = min(self.tiles, key=self.used.get)
+            # A view needing more tiles than the pool holds grows the pool
+            if self.used[oldest] != self.frame:
+                del self.used[oldest]
+                return self.tiles.pop(oldest)
+        texture = pyglet.image.Texture.create(TILE_SIZE, TILE_SIZE)
+        sprite = pyglet.sprite.Sprite(texture, batch=self.batch,
+                                      group=self.group)
+        return texture, sprite
+
+    def load_tile(self, column, row):
+        width, height = self.get_tile_size(column, row)
+        if self.memory_tiles is not None:
+            pixels = zlib.decompress(self.memory_tiles[column, row])
+        else:
+            f = open(_tile_path(self.filename, column, row), 'rb')
+            try:
+                pixels = zlib.decompress(f.read())
+            finally:
+                f.close()
+
+        texture, sprite = self.get_slot()
+        texture.blit_into(pyglet.image.ImageData(width, height, 'RGBA',
+                                                 pixels), 0, 0, 0)
+        sprite.image = texture.get_region(0, 0, width, height)
+        sprite.position = (column * TILE_SIZE, row * TILE_SIZE)
+        self.tiles[column, row] = texture, sprite
+        self.loads += 1
+
+    def update(self, view):
+        '''Make sure the tiles within STREAM_MARGIN of "view", a (left,
+        bottom, right, top) rectangle in world coordinates, are loaded.
+        '''
+        self.frame += 1
+        left, bottom, right, top = view
+        first_column = max(0, int(left - STREAM_MARGIN) // TILE_SIZE)
+        last_column = min(self.columns - 1,
+                          int(right + STREAM_MARGIN) // TILE_SIZE)
+        first_row = max(0, int(bottom - STREAM_MARGIN) // TILE_SIZE)
+        last_row = min(self.rows - 1, int(top + STREAM_MARGIN) // TILE_SIZE)
+
+        for column in xrange(first_column, last_column + 1):
+            for row in xrange(first_row, last_row + 1):
+                self.used[column, row] = self.frame
+                if (column, row) not in self.tiles:
+                    self.load_tile(column, row)
+
+    def delete(self):
+        for texture, sprite in self.tiles.values():
+            sprite.delete()
+        self.tiles.clear()
+        self.used.clear()
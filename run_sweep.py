@@ -0,0 +1,10 @@
+#! /usr/bin/env python
+
+import multiprocessing
+
+from gamelib import sweep
+
+# Worker processes import this module again on Windows
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sweep.main()